@@ -0,0 +1,839 @@
+"""Offline load test for the bot handlers.
+
+Drives the real handlers in main.py with synthetic telegram.Update objects
+against in-memory fakes of Firestore, Firebase Storage, Google Drive and the
+Telegram Bot API. Every fake call sleeps for a configurable latency and is
+counted, so each scenario reports throughput, p50/p99 handler latency and
+the number of backend calls it needed.
+
+    python benchmark.py --scenario all --pairs 50 --messages 20
+    python benchmark.py --scenario queue-storm --users 2000 --latency firestore=10,telegram=30
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytz
+
+
+# Latensi buatan per backend (detik), diubah lewat --latency
+LATENCY = {'firestore': 0.005, 'telegram': 0.02, 'drive': 0.05, 'storage': 0.03}
+
+ADMIN_ID = 2082265412
+
+
+class BackendCalls:
+    """Thread-safe counter of fake backend calls, keyed by (backend, operation)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def call(self, backend, operation):
+        with self.lock:
+            self.counts[(backend, operation)] += 1
+        delay = LATENCY.get(backend, 0)
+        if delay:
+            time.sleep(delay)
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+    def summary(self):
+        with self.lock:
+            grouped = defaultdict(dict)
+            for (backend, operation), count in sorted(self.counts.items()):
+                grouped[backend][operation] = count
+            return dict(grouped)
+
+
+calls = BackendCalls()
+
+
+# ---------------------------------------------------------------------------
+# Firestore palsu
+# ---------------------------------------------------------------------------
+
+def _resolve(value):
+    from firebase_admin import firestore
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(pytz.utc)
+    return value
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeChange:
+    def __init__(self, kind, snapshot):
+        self.type = SimpleNamespace(name=kind)
+        self.document = snapshot
+
+
+class FakeWatch:
+    def __init__(self, collection, callback):
+        self.collection = collection
+        self.callback = callback
+
+    def unsubscribe(self):
+        self.collection.db.watchers[self.collection.path].remove(self)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection_path, doc_id):
+        self.db = db
+        self.collection_path = collection_path
+        self.id = doc_id
+        self.path = f'{collection_path}/{doc_id}'
+
+    def collection(self, name):
+        return FakeCollection(self.db, f'{self.path}/{name}')
+
+    def get(self, transaction=None):
+        calls.call('firestore', 'get')
+        return FakeSnapshot(self, self.db.read(self.path))
+
+    def set(self, data, merge=False):
+        calls.call('firestore', 'set')
+        self.db.apply([('merge' if merge else 'set', self, data)])
+
+    def update(self, data):
+        calls.call('firestore', 'update')
+        self.db.apply([('update', self, data)])
+
+    def delete(self):
+        calls.call('firestore', 'delete')
+        self.db.apply([('delete', self, None)])
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), order=None, fields=None, limit=None, after=None):
+        self.collection = collection
+        self.filters = list(filters)
+        self.order = order
+        self.fields = fields
+        self._limit = limit
+        self.after = after
+
+    def _copy(self, **changes):
+        params = dict(filters=self.filters, order=self.order, fields=self.fields, limit=self._limit, after=self.after)
+        params.update(changes)
+        return FakeQuery(self.collection, **params)
+
+    def where(self, field, op, value):
+        assert op == '==', 'FakeQuery only supports equality filters'
+        return self._copy(filters=self.filters + [(field, value)])
+
+    def order_by(self, field, direction=None):
+        return self._copy(order=field)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def limit_to_last(self, count):
+        return self._copy(limit=-count)
+
+    def start_after(self, values):
+        return self._copy(after=values)
+
+    def _sort_key(self, item):
+        doc_id, data = item
+        if self.order in (None, '__name__'):
+            return doc_id
+        value = data.get(self.order)
+        return (value is None, value)
+
+    def stream(self, transaction=None):
+        calls.call('firestore', 'query')
+        items = [(doc_id, data) for doc_id, data in self.collection.db.documents(self.collection.path)
+                 if all(data.get(field) == value for field, value in self.filters)]
+        items.sort(key=self._sort_key)
+        if self.after is not None:
+            field, value = next(iter(self.after.items()))
+            if field == '__name__':
+                items = [item for item in items if item[0] > value]
+            else:
+                items = [item for item in items if item[1].get(field) is not None and item[1].get(field) > value]
+        if self._limit is not None:
+            items = items[:self._limit] if self._limit > 0 else items[self._limit:]
+        for doc_id, data in items:
+            yield FakeSnapshot(self.collection.document(doc_id), data)
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self.db, self.path, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+    def on_snapshot(self, callback):
+        calls.call('firestore', 'listen')
+        watch = FakeWatch(self, callback)
+        self.db.watchers[self.path].append(watch)
+        snapshots = [FakeSnapshot(self.document(doc_id), data) for doc_id, data in self.db.documents(self.path)]
+        callback(snapshots, [FakeChange('ADDED', snapshot) for snapshot in snapshots], None)
+        return watch
+
+
+class FakeWriteBatch:
+    def __init__(self, db, operation='batch_commit'):
+        self.db = db
+        self.operation = operation
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append(('merge' if merge else 'set', reference, data))
+
+    def update(self, reference, data):
+        self.writes.append(('update', reference, data))
+
+    def delete(self, reference):
+        self.writes.append(('delete', reference, None))
+
+    def commit(self):
+        calls.call('firestore', self.operation)
+        self.db.apply(self.writes)
+        self.writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    def __init__(self, db):
+        super().__init__(db, 'transaction_commit')
+
+
+class FakeFirestore:
+    """Minimal in-memory Firestore covering the calls main.py makes."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Semua transaksi diserialkan; cukup untuk memeriksa klaim atomik
+        self.transaction_lock = threading.RLock()
+        self.data = defaultdict(dict)  # path koleksi -> {doc_id: data}
+        self.watchers = defaultdict(list)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def read(self, path):
+        collection_path, doc_id = path.rsplit('/', 1)
+        with self.lock:
+            data = self.data[collection_path].get(doc_id)
+            return dict(data) if data is not None else None
+
+    def documents(self, collection_path):
+        with self.lock:
+            return [(doc_id, dict(data)) for doc_id, data in self.data[collection_path].items()]
+
+    def apply(self, writes):
+        from google.api_core.exceptions import NotFound
+        changes = []
+        with self.lock:
+            for kind, reference, data in writes:
+                documents = self.data[reference.collection_path]
+                if kind == 'set':
+                    documents[reference.id] = {key: _resolve(value) for key, value in data.items()}
+                elif kind == 'merge':
+                    documents.setdefault(reference.id, {}).update({key: _resolve(value) for key, value in data.items()})
+                elif kind == 'update':
+                    if reference.id not in documents:
+                        raise NotFound(f'No document to update: {reference.path}')
+                    documents[reference.id].update({key: _resolve(value) for key, value in data.items()})
+                else:
+                    if documents.pop(reference.id, None) is None:
+                        continue
+                changes.append((reference, kind))
+            watchers = {path: list(items) for path, items in self.watchers.items()}
+        for reference, kind in changes:
+            for watch in watchers.get(reference.collection_path, []):
+                snapshot = FakeSnapshot(reference, self.read(reference.path))
+                watch.callback([], [FakeChange('REMOVED' if kind == 'delete' else 'MODIFIED', snapshot)], None)
+
+
+def fake_transactional(fn):
+    # Pengganti firestore.transactional: jalankan fungsi lalu commit, serial per db
+    def run(transaction, *args, **kwargs):
+        with transaction.db.transaction_lock:
+            result = fn(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return run
+
+
+# ---------------------------------------------------------------------------
+# Storage, Drive dan Telegram palsu
+# ---------------------------------------------------------------------------
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.public_url = f'https://storage.example/{name}'
+
+    def exists(self):
+        calls.call('storage', 'exists')
+        with self.bucket.lock:
+            return self.name in self.bucket.blobs
+
+    def upload_from_file(self, file_obj, content_type=None, size=None, **kwargs):
+        calls.call('storage', 'upload')
+        data = file_obj.read()
+        with self.bucket.lock:
+            self.bucket.blobs[self.name] = len(data)
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        with open(filename, 'rb') as file_obj:
+            self.upload_from_file(file_obj, content_type=content_type)
+
+
+class FakeBucket:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self, name)
+
+
+class FakeDriveRequest:
+    def __init__(self, operation, result):
+        self.operation = operation
+        self.result = result
+
+    def execute(self):
+        calls.call('drive', self.operation)
+        return self.result
+
+
+class FakeDriveFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q=None, **kwargs):
+        with self.drive.lock:
+            files = [{'id': file_id} for file_id, name in self.drive.stored.items() if f"name='{name}'" in (q or '')]
+        return FakeDriveRequest('files.list', {'files': files})
+
+    def create(self, body=None, media_body=None, **kwargs):
+        file_id = uuid.uuid4().hex
+        with self.drive.lock:
+            self.drive.stored[file_id] = body['name']
+        return FakeDriveRequest('files.create', {'id': file_id})
+
+    def update(self, fileId=None, media_body=None, **kwargs):
+        return FakeDriveRequest('files.update', {'id': fileId})
+
+
+class FakeDrive:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stored = {}
+
+    def files(self):
+        return FakeDriveFiles(self)
+
+
+class FakeFile:
+    def __init__(self, file_id, size=64 * 1024):
+        self.file_id = file_id
+        self.file_unique_id = f'u-{file_id}'
+        self.file_path = f'https://api.telegram.example/file/{file_id}'
+        self.size = size
+
+    def download(self, custom_path=None, out=None, timeout=None):
+        calls.call('telegram', 'download')
+        data = b'\0' * self.size
+        if out is not None:
+            out.write(data)
+            return out
+        with open(custom_path, 'wb') as file_obj:
+            file_obj.write(data)
+        return custom_path
+
+
+class FakeBot:
+    """Stand-in for telegram.Bot that records every API method it is asked to call."""
+
+    id = 1
+    username = 'benchmark_bot'
+    first_name = 'Benchmark'
+
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+
+    def _message(self, chat_id, **fields):
+        return SimpleNamespace(message_id=next(self.message_ids), chat_id=chat_id, **fields)
+
+    def send_message(self, chat_id, text, **kwargs):
+        calls.call('telegram', 'sendMessage')
+        return self._message(chat_id, text=text)
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        calls.call('telegram', 'sendPhoto')
+        file_id = photo if isinstance(photo, str) and not photo.startswith('http') else 'uploaded-photo'
+        return self._message(chat_id, photo=[SimpleNamespace(file_id=file_id, file_unique_id=f'u-{file_id}')])
+
+    def send_sticker(self, chat_id, sticker, **kwargs):
+        calls.call('telegram', 'sendSticker')
+        return self._message(chat_id)
+
+    def send_voice(self, chat_id, voice, **kwargs):
+        calls.call('telegram', 'sendVoice')
+        return self._message(chat_id)
+
+    def send_location(self, chat_id, latitude=None, longitude=None, **kwargs):
+        calls.call('telegram', 'sendLocation')
+        return self._message(chat_id)
+
+    def get_user_profile_photos(self, user_id, offset=None, limit=None, **kwargs):
+        calls.call('telegram', 'getUserProfilePhotos')
+        photo = SimpleNamespace(file_id=f'profile-{user_id}', file_unique_id=f'u-profile-{user_id}')
+        return SimpleNamespace(total_count=1, photos=[[photo]])
+
+    def get_file(self, file_id, **kwargs):
+        calls.call('telegram', 'getFile')
+        return FakeFile(file_id)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        calls.call('telegram', 'answerCallbackQuery')
+        return True
+
+
+# ---------------------------------------------------------------------------
+# Import main.py dengan backend palsu
+# ---------------------------------------------------------------------------
+
+def load_bot_module(workdir):
+    os.environ['ARCHIVE_SPOOL_PATH'] = os.path.join(workdir, 'archive_spool.jsonl')
+    os.environ['DRIVE_FILE_INDEX_PATH'] = os.path.join(workdir, 'drive_file_index.json')
+    os.environ['STICKER_INDEX_PATH'] = os.path.join(workdir, 'sticker_index.jsonl')
+
+    # Dekorator transaksi dipasang saat import, jadi harus diganti lebih dulu
+    from firebase_admin import firestore
+    firestore.transactional = fake_transactional
+
+    import main
+    main._db = FakeFirestore()
+    main._bucket = FakeBucket()
+    drive = FakeDrive()
+    main.authenticate_google_drive = lambda: drive
+    main.LOG_DIR = workdir
+    return main
+
+
+def reset_state(main):
+    """Give the next scenario a fresh fake database and empty in-process caches."""
+    main._db = FakeFirestore()
+    main._bucket = FakeBucket()
+    main.state_backend = main.create_state_backend()
+    with main._partner_cache_lock:
+        main._partner_cache.clear()
+    with main._waiting_lock:
+        main._waiting_queue.clear()
+        main._waiting_set.clear()
+    with main._banned_lock:
+        main._banned_ids.clear()
+    main._last_photo_cache.clear()
+    main._user_info_cache.clear()
+    with main._message_cond:
+        main._message_buffer.clear()
+    calls.reset()
+
+
+# ---------------------------------------------------------------------------
+# Update sintetis
+# ---------------------------------------------------------------------------
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+
+def make_update(bot, user_id, text=None, **message_fields):
+    from telegram import Update
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+    }
+    if text is not None:
+        message['text'] = text
+    message.update(message_fields)
+    return Update.de_json({'update_id': next(_update_ids), 'message': message}, bot)
+
+
+def make_photo_update(bot, user_id):
+    file_id = f'photo-{uuid.uuid4().hex[:12]}'
+    photo = {'file_id': file_id, 'file_unique_id': f'u-{file_id}', 'width': 800, 'height': 600}
+    return make_update(bot, user_id, photo=[photo])
+
+
+def make_context(bot, args=()):
+    return SimpleNamespace(bot=bot, args=list(args))
+
+
+class Timer:
+    """Collects per-call handler latencies; the clock starts at begin(), after setup."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.started = None
+        self.wall = None  # Diisi skenario yang mengukur waktunya sendiri
+
+    def begin(self):
+        calls.reset()
+        self.started = time.perf_counter()
+
+    def run(self, handler, update, context):
+        started = time.perf_counter()
+        handler(update, context)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples.append(elapsed)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# ---------------------------------------------------------------------------
+# Skenario
+# ---------------------------------------------------------------------------
+
+def register_users(main, user_ids):
+    for user_id in user_ids:
+        main._db.data['users'][str(user_id)] = {'username': f'user{user_id}', 'photo': None, 'status': 'registered'}
+
+
+def pair_users(main, bot, pairs):
+    # Setup (tidak diukur): a menunggu, b menemukan a
+    for user_a, user_b in pairs:
+        main.search(make_update(bot, user_a, '/search'), make_context(bot))
+        main.search(make_update(bot, user_b, '/search'), make_context(bot))
+
+
+def drain_background(main, timeout=120):
+    """Seal open chat-log segments and wait until the archive pipeline has nothing left to do."""
+    main.seal_all_log_segments()
+    main.flush_message_events()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = main.get_archive_pipeline_stats()
+        if stats['queue_depth'] == 0 and stats['enqueued'] <= stats['completed'] + stats['failed']:
+            return
+        time.sleep(0.02)
+    logging.warning('Archive pipeline did not drain within %ss', timeout)
+
+
+def active_sessions(main):
+    """Return {user_id: partner_id} as stored by the configured state backend."""
+    if main.state_backend.name == 'memory':
+        return dict(main.state_backend._active)
+    return {user_id: str(chat['partner']) for user_id, chat in main._db.data['active_chats'].items()}
+
+
+def waiting_users(main):
+    return main.state_backend.load_waiting()
+
+
+def check_sessions(main):
+    """Return the number of inconsistent session entries (non-symmetric pairs)."""
+    active = active_sessions(main)
+    return sum(1 for user_id, partner_id in active.items() if active.get(partner_id) != user_id)
+
+
+def scenario_pairs(main, bot, options, timer):
+    users = list(range(100000, 100000 + 2 * options.pairs))
+    pairs = list(zip(users[0::2], users[1::2]))
+    register_users(main, users)
+    pair_users(main, bot, pairs)
+
+    def chat(pair):
+        for index in range(options.messages):
+            sender = pair[index % 2]
+            timer.run(main.handle_message, make_update(bot, sender, f'pesan {index}'), make_context(bot))
+
+    timer.begin()
+    with ThreadPoolExecutor(options.workers) as pool:
+        list(pool.map(chat, pairs))
+    return len(pairs) * options.messages, {}
+
+
+def scenario_photos(main, bot, options, timer):
+    users = list(range(200000, 200000 + 2 * options.pairs))
+    pairs = list(zip(users[0::2], users[1::2]))
+    register_users(main, users)
+    pair_users(main, bot, pairs)
+
+    def send_photos(pair):
+        for index in range(max(1, options.messages // 4)):
+            timer.run(main.handle_photo, make_photo_update(bot, pair[index % 2]), make_context(bot))
+
+    timer.begin()
+    with ThreadPoolExecutor(options.workers) as pool:
+        list(pool.map(send_photos, pairs))
+    return len(timer.samples), {}
+
+
+def scenario_queue_storm(main, bot, options, timer):
+    users = list(range(300000, 300000 + options.users))
+    register_users(main, users)
+
+    def do_search(user_id):
+        timer.run(main.search, make_update(bot, user_id, '/search'), make_context(bot))
+
+    timer.begin()
+    with ThreadPoolExecutor(options.workers) as pool:
+        list(pool.map(do_search, users))
+    return len(users), {'paired_users': len(active_sessions(main)), 'waiting_users': len(waiting_users(main)),
+                        'inconsistent_sessions': check_sessions(main)}
+
+
+def scenario_mass_next(main, bot, options, timer):
+    users = list(range(400000, 400000 + 2 * options.pairs))
+    pairs = list(zip(users[0::2], users[1::2]))
+    register_users(main, users)
+    pair_users(main, bot, pairs)
+
+    def do_next(user_id):
+        timer.run(main.next_chat, make_update(bot, user_id, '/next'), make_context(bot))
+
+    timer.begin()
+    with ThreadPoolExecutor(options.workers) as pool:
+        list(pool.map(do_next, users))
+    return len(users), {'paired_users': len(active_sessions(main)),
+                        'inconsistent_sessions': check_sessions(main)}
+
+
+def scenario_stop(main, bot, options, timer):
+    users = list(range(500000, 500000 + 2 * options.pairs))
+    pairs = list(zip(users[0::2], users[1::2]))
+    register_users(main, users)
+    pair_users(main, bot, pairs)
+
+    def do_stop(pair):
+        timer.run(main.stop_chat, make_update(bot, pair[0], '/stop'), make_context(bot))
+
+    timer.begin()
+    with ThreadPoolExecutor(options.workers) as pool:
+        list(pool.map(do_stop, pairs))
+    return len(pairs), {'paired_users': len(active_sessions(main))}
+
+
+def scenario_broadcast(main, bot, options, timer):
+    users = list(range(600000, 600000 + options.users))
+    register_users(main, users + [ADMIN_ID])
+
+    timer.begin()
+    timer.run(main.broadcast, make_update(bot, ADMIN_ID, '/broadcast halo'), make_context(bot, ['halo']))
+    for thread in list(main._broadcast_threads):
+        thread.join()
+    main._broadcast_threads.clear()
+    job = next(iter(main._db.data['broadcast_jobs'].values()))
+    elapsed = time.perf_counter() - timer.started
+    return len(users), {'sent': job['sent'], 'failed': job['failed'], 'blocked': job['blocked'],
+                        'delivery_s': round(elapsed, 3)}
+
+
+def _lease_race_worker(state_path, worker_index, worker_count, searchers):
+    # Proses worker terpisah: main.py dengan state backend file bersama
+    os.environ.update(STATE_BACKEND='file', STATE_FILE_PATH=state_path, WORKER_COUNT=str(worker_count),
+                      WORKER_INDEX=str(worker_index), WORKER_ID=f'benchmark-worker-{worker_index}')
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    main.load_waiting_queue()
+    results = []
+    started = time.time()
+    for searcher in searchers:
+        claim_started = time.perf_counter()
+        partner_id = main.claim_waiting_partner(searcher)
+        results.append((searcher, partner_id, time.perf_counter() - claim_started))
+    return started, time.time(), results
+
+
+def scenario_lease_race(main, bot, options, timer):
+    """Several worker processes claim partners from one shared file store at the same time."""
+    state_path = os.path.join(tempfile.mkdtemp(prefix='bot-lease-race-'), 'state.json')
+    store = main.FileStateBackend(state_path)
+    waiting = [str(user_id) for user_id in range(700000, 700000 + options.users)]
+    with store._shared_state():
+        for user_id in waiting:
+            store.add_waiting(user_id)
+    searchers = [str(user_id) for user_id in range(800000, 800000 + options.users)]
+    chunks = [searchers[index::options.processes] for index in range(options.processes)]
+
+    timer.begin()
+    with ProcessPoolExecutor(options.processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_lease_race_worker, state_path, index, options.processes, chunk)
+                   for index, chunk in enumerate(chunks)]
+        outcomes = [future.result() for future in futures]
+    timer.wall = max(end for _, end, _ in outcomes) - min(start for start, _, _ in outcomes)
+
+    claimed = []
+    for _, _, results in outcomes:
+        for searcher, partner_id, elapsed in results:
+            timer.samples.append(elapsed)
+            if partner_id is not None:
+                claimed.append(partner_id)
+    with store._shared_state(write=False):
+        active = dict(store._active)
+        waiting_left = len(store._waiting)
+    return len(searchers), {'processes': options.processes, 'pairs': len(claimed),
+                            'double_claims': len(claimed) - len(set(claimed)),
+                            'waiting_left': waiting_left,
+                            'inconsistent_sessions': sum(1 for user_id, partner_id in active.items()
+                                                         if active.get(partner_id) != user_id)}
+
+
+SCENARIOS = {
+    'pairs': scenario_pairs,
+    'photos': scenario_photos,
+    'queue-storm': scenario_queue_storm,
+    'mass-next': scenario_mass_next,
+    'stop': scenario_stop,
+    'broadcast': scenario_broadcast,
+    'lease-race': scenario_lease_race,
+}
+
+
+def run_scenario(main, bot, name, options):
+    reset_state(main)
+    timer = Timer()
+    operations, extra = SCENARIOS[name](main, bot, options, timer)
+    wall = timer.wall if timer.wall is not None else time.perf_counter() - timer.started
+    drained = time.perf_counter()
+    drain_background(main)
+    extra['background_s'] = round(time.perf_counter() - drained, 3)
+    return {
+        'scenario': name,
+        'operations': operations,
+        'wall_s': round(wall, 3),
+        'throughput_ops_s': round(operations / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(timer.samples, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(timer.samples, 0.99) * 1000, 2),
+        'backend_calls': calls.summary(),
+        **extra,
+    }
+
+
+def parse_latency(value):
+    latency = {}
+    for item in value.split(','):
+        backend, milliseconds = item.split('=')
+        latency[backend.strip()] = float(milliseconds) / 1000
+    return latency
+
+
+def print_report(results):
+    print(f"{'scenario':<12} {'ops':>7} {'wall_s':>8} {'ops/s':>9} {'p50_ms':>8} {'p99_ms':>8}")
+    for result in results:
+        print(f"{result['scenario']:<12} {result['operations']:>7} {result['wall_s']:>8} "
+              f"{result['throughput_ops_s']:>9} {result['p50_ms']:>8} {result['p99_ms']:>8}")
+    for result in results:
+        print(f"\n[{result['scenario']}]")
+        for backend, operations in result['backend_calls'].items():
+            total = sum(operations.values())
+            detail = ', '.join(f'{operation}={count}' for operation, count in operations.items())
+            print(f'  {backend:<9} {total:>7}  ({detail})')
+        extra = {key: value for key, value in result.items()
+                 if key not in ('scenario', 'operations', 'wall_s', 'throughput_ops_s', 'p50_ms', 'p99_ms', 'backend_calls')}
+        if extra:
+            print('  ' + ', '.join(f'{key}={value}' for key, value in extra.items()))
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', default='all', choices=['all'] + list(SCENARIOS))
+    parser.add_argument('--pairs', type=int, default=50, help='chat pairs for pairs/photos/mass-next/stop')
+    parser.add_argument('--messages', type=int, default=20, help='messages per pair')
+    parser.add_argument('--users', type=int, default=500, help='users for queue-storm/broadcast')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--processes', type=int, default=4, help='worker processes for lease-race')
+    parser.add_argument('--latency', type=parse_latency, default={},
+                        help='fake backend latency in ms, e.g. firestore=5,telegram=20,drive=50,storage=30')
+    parser.add_argument('--broadcast-rate', type=float, default=1000.0, help='BROADCAST_RATE for the broadcast scenario')
+    parser.add_argument('--state-backend', default='firestore', choices=['firestore', 'memory'],
+                        help='STATE_BACKEND used for waiting, active and banned state')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='keep the bot INFO logs')
+    options = parser.parse_args(argv)
+
+    LATENCY.update(options.latency)
+    os.environ['BROADCAST_RATE'] = str(options.broadcast_rate)
+    os.environ['STATE_BACKEND'] = options.state_backend
+
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    main = load_bot_module(workdir)
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    bot = FakeBot()
+    main.start_archive_pipeline(bot)
+    main.start_log_uploader()
+    main.start_message_writer()
+
+    names = list(SCENARIOS) if options.scenario == 'all' else [options.scenario]
+    results = [run_scenario(main, bot, name, options) for name in names]
+
+    main.stop_log_uploader()
+    main.stop_message_writer()
+    main.stop_archive_pipeline()
+
+    print_report(results)
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
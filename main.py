@@ -3,15 +3,44 @@ from firebase_admin import credentials, firestore, storage
 from telegram import Update
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackQueryHandler
+from telegram.ext import CallbackQueryHandler, TypeHandler, DispatcherHandlerStop, ExtBot
+from telegram.utils.request import Request
+from telegram.utils.helpers import DEFAULT_NONE
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
 import os
+import sys
 import json
 import io
+import re
+import shutil
+import tempfile
+import uuid
+import gzip
+import threading
+import time
+import queue
+import heapq
+import random
+import functools
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+import hmac
+import secrets
+import signal
+import fcntl
+import subprocess
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
 
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from google.cloud.firestore_v1.field_path import FieldPath
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 
 
 from datetime import datetime
@@ -27,98 +56,1356 @@ logging.basicConfig(level=logging.INFO,
 
 # Ambil kredensial dari variabel lingkungan
 DRIVE_CREDENTIALS_JSON = os.getenv('DRIVE_CREDENTIALS')
+FIREBASE_STORAGE_BUCKET = os.getenv('FIREBASE_STORAGE_BUCKET', 'list-bot--telegram.appspot.com')  # Ganti dengan ID bucket Anda
 
-if DRIVE_CREDENTIALS_JSON is None:
-    logging.error('DRIVE_CREDENTIALS is not set.')
-else:
+# Waktu modul dimuat, untuk melaporkan lama startup sampai bot menerima update
+_process_started = time.monotonic()
+startup_seconds = None
+
+
+def report_startup(mode):
+    global startup_seconds
+    startup_seconds = time.monotonic() - _process_started
+    logging.info(f'Bot started in {mode} mode in {startup_seconds:.2f}s.')
+
+
+def check_drive_credentials():
+    if DRIVE_CREDENTIALS_JSON is None:
+        logging.error('DRIVE_CREDENTIALS is not set.')
+        return
     try:
-        drive_credentials = json.loads(DRIVE_CREDENTIALS_JSON)
+        json.loads(DRIVE_CREDENTIALS_JSON)
         logging.info('DRIVE_CREDENTIALS JSON is valid.')
     except json.JSONDecodeError:
         logging.error('Invalid JSON format in DRIVE_CREDENTIALS.')
 
 
-# Load the JSON credentials from an environment variable
-google_credentials = json.loads(os.environ.get('GOOGLE_CREDENTIALS'))
+# Firebase (Firestore dan Storage) diinisialisasi saat pertama kali dipakai,
+# bukan saat import, sehingga modul bisa diimpor tanpa kredensial dan bot
+# tidak menunggu klien yang belum dibutuhkan.
+_firebase_lock = threading.Lock()
+_firebase_app = None
+_db = None
+_bucket = None
+
+
+def get_firebase_app():
+    global _firebase_app
+    if _firebase_app is None:
+        with _firebase_lock:
+            if _firebase_app is None:
+                started = time.monotonic()
+                google_credentials = json.loads(os.environ.get('GOOGLE_CREDENTIALS'))
+                cred = credentials.Certificate(google_credentials)
+                _firebase_app = firebase_admin.initialize_app(cred, {'storageBucket': FIREBASE_STORAGE_BUCKET})
+                logging.info(f'Firebase initialized in {time.monotonic() - started:.2f}s.')
+    return _firebase_app
+
+
+def get_db():
+    """Return the Firestore client, creating it on first use."""
+    global _db
+    if _db is None:
+        app = get_firebase_app()
+        with _firebase_lock:
+            if _db is None:
+                _db = firestore.client(app)
+    return _db
+
+
+def get_bucket():
+    """Return the Storage bucket, creating it on first use."""
+    global _bucket
+    if _bucket is None:
+        app = get_firebase_app()
+        with _firebase_lock:
+            if _bucket is None:
+                _bucket = storage.bucket(app=app)
+    return _bucket
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate(google_credentials)
 
-    
-# Inisialisasi Firebase
-firebase_admin.initialize_app(
-    cred,
-    {
-        'storageBucket': 'list-bot--telegram.appspot.com'  # Ganti dengan ID bucket Anda
-    }
-)
+# Token dari BotFather
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
-db = firestore.client()
 
-# Dapatkan referensi bucket
-bucket = storage.bucket()
+# Metrik format Prometheus: histogram latensi dan counter error per handler,
+# serta jumlah dan durasi panggilan ke Firestore, Telegram, Drive dan Storage.
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics_lock = threading.Lock()
+_metric_counters = {}  # (nama, label) -> nilai
+_metric_histograms = {}  # (nama, label) -> [jumlah per bucket..., sum, count]
+
+
+def inc_counter(name, labels=(), amount=1):
+    with _metrics_lock:
+        key = (name, tuple(labels))
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+
+def observe_histogram(name, labels, value):
+    with _metrics_lock:
+        key = (name, tuple(labels))
+        histogram = _metric_histograms.get(key)
+        if histogram is None:
+            histogram = _metric_histograms[key] = [0] * len(METRICS_LATENCY_BUCKETS) + [0.0, 0]
+        for index, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+@contextmanager
+def observe_backend(backend, operation):
+    """Count and time one call to an external backend (firestore, telegram, drive, storage)."""
+    labels = (('backend', backend), ('operation', operation))
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        inc_counter('bot_backend_errors_total', labels)
+        raise
+    finally:
+        inc_counter('bot_backend_calls_total', labels)
+        observe_histogram('bot_backend_call_seconds', labels, time.monotonic() - started)
+
+
+def timed_execute(request, operation):
+    # Jalankan request Google Drive API dengan metrik
+    with observe_backend('drive', operation):
+        return request.execute()
+
+
+def instrument_handler(name, callback):
+    """Wrap a handler callback with a latency histogram and an error counter."""
+    labels = (('handler', name),)
+
+    @functools.wraps(callback)
+    def instrumented(update: Update, context: CallbackContext):
+        started = time.monotonic()
+        try:
+            return callback(update, context)
+        except Exception:
+            inc_counter('bot_handler_errors_total', labels)
+            raise
+        finally:
+            observe_histogram('bot_handler_seconds', labels, time.monotonic() - started)
+    return instrumented
+
+
+class InstrumentedBot(ExtBot):
+    """ExtBot that counts and times every Bot API request and queues outgoing messages."""
+
+    def _post(self, endpoint, data=None, timeout=DEFAULT_NONE, api_kwargs=None):
+        with observe_backend('telegram', endpoint):
+            return super()._post(endpoint, data, timeout, api_kwargs)
+
+    def _message(self, endpoint, data, *args, **kwargs):
+        # Semua send_* ke sebuah chat lewat outbox (lihat "Pengiriman keluar")
+        chat_id = data.get('chat_id')
+        if chat_id is None or not outbox_accepts():
+            return super()._message(endpoint, data, *args, **kwargs)
+        future = submit_outbound(str(chat_id), endpoint,
+                                 functools.partial(super()._message, endpoint, data, *args, **kwargs))
+        if getattr(_outbox_local, 'wait', False):
+            return future.result()
+        return None
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+def _collect_gauges():
+    # Statistik layanan lain, dibaca saat /metrics diminta
+    cache = get_partner_cache_stats()
+    backlog = get_log_upload_backlog()
+    archive = get_archive_pipeline_stats()
+    updates = update_executor.get_stats()
+    outbox = get_outbox_stats()
+    gauges = [
+        ('bot_partner_cache_hits_total', 'counter', cache['hits']),
+        ('bot_partner_cache_misses_total', 'counter', cache['misses']),
+        ('bot_partner_cache_entries', 'gauge', cache['size']),
+        ('bot_log_upload_backlog_files', 'gauge', backlog['files']),
+        ('bot_log_upload_backlog_bytes', 'gauge', backlog['bytes']),
+        ('bot_archive_queue_depth', 'gauge', archive['queue_depth']),
+        ('bot_archive_spooled_jobs', 'gauge', archive['spooled']),
+        ('bot_archive_retry_pending', 'gauge', archive['retry_pending']),
+        ('bot_archive_jobs_completed_total', 'counter', archive['completed']),
+        ('bot_archive_jobs_failed_total', 'counter', archive['failed']),
+        ('bot_update_queue_depth', 'gauge', updates['queued']),
+        ('bot_outbox_queue_depth', 'gauge', outbox['queued']),
+        ('bot_outbox_sent_total', 'counter', outbox['sent']),
+        ('bot_outbox_retried_total', 'counter', outbox['retried']),
+        ('bot_outbox_blocked_users', 'gauge', outbox['blocked_known']),
+        ('bot_waiting_users', 'gauge', len(_waiting_set)),
+        ('bot_banned_users', 'gauge', len(_banned_ids)),
+    ]
+    if BOT_MODE == 'webhook':
+        gauges.append(('bot_webhook_queue_depth', 'gauge', get_webhook_queue_depth()))
+    if startup_seconds is not None:
+        gauges.append(('bot_startup_seconds', 'gauge', startup_seconds))
+    return gauges
+
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        counters = sorted(_metric_counters.items())
+        histograms = sorted((key, list(value)) for key, value in _metric_histograms.items())
+
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), histogram in histograms:
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        for index, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {histogram[index]}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram[-1]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-2]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram[-1]}')
+    for name, metric_type, value in _collect_gauges():
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Metrics {self.address_string()}: {format % args}')
+
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    server = ThreadingHTTPServer((METRICS_LISTEN, int(METRICS_PORT)), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f'Metrics available at http://{METRICS_LISTEN}:{METRICS_PORT}/metrics')
 
-# Token dari BotFather
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+
+# Cache pasangan chat aktif (user_id -> partner_id) agar relay pesan tidak
+# perlu bertanya ke state backend setiap kali.
+PARTNER_CACHE_SIZE = int(os.getenv('PARTNER_CACHE_SIZE', '10000'))
+PARTNER_CACHE_TTL = float(os.getenv('PARTNER_CACHE_TTL', '300'))
+
+_partner_cache = OrderedDict()
+_partner_cache_lock = threading.Lock()
+partner_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def cache_partner(user_id, partner_id):
+    """Write-through: simpan pasangan (atau None jika tidak sedang chat)."""
+    key = str(user_id)
+    with _partner_cache_lock:
+        _partner_cache[key] = (partner_id, time.monotonic() + PARTNER_CACHE_TTL)
+        _partner_cache.move_to_end(key)
+        while len(_partner_cache) > PARTNER_CACHE_SIZE:
+            _partner_cache.popitem(last=False)
+
+
+def get_partner(user_id):
+    """Return partner_id of the active chat, or None, asking the state backend only on a cache miss."""
+    key = str(user_id)
+    with _partner_cache_lock:
+        entry = _partner_cache.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            _partner_cache.move_to_end(key)
+            partner_cache_stats['hits'] += 1
+            return entry[0]
+        partner_cache_stats['misses'] += 1
+
+    partner_id = state_backend.get_partner(key)
+    cache_partner(key, partner_id)
+    return partner_id
+
+
+def get_partner_cache_stats():
+    with _partner_cache_lock:
+        return dict(partner_cache_stats, size=len(_partner_cache))
+
+
+# Klien Google Drive: kredensial dan discovery hanya diproses sekali. Dokumen
+# discovery diambil dari salinan yang dibundel googleapiclient (tanpa request
+# jaringan). Objek service (httplib2) tidak thread-safe, jadi setiap thread
+# mendapat service sendiri yang dibangun dari dokumen discovery yang sama.
+_drive_credentials = None
+_drive_discovery_doc = None
+_drive_init_lock = threading.Lock()
+_drive_local = threading.local()
 
 
 def authenticate_google_drive():
+    service = getattr(_drive_local, 'service', None)
+    if service is not None:
+        return service
+
+    global _drive_credentials, _drive_discovery_doc
     try:
-        credentials_info = json.loads(DRIVE_CREDENTIALS_JSON)
-        credentials = service_account.Credentials.from_service_account_info(credentials_info)
-        service = build('drive', 'v3', credentials=credentials)
-        logging.info('Google Drive authenticated successfully.')
+        with _drive_init_lock:
+            if _drive_credentials is None:
+                credentials_info = json.loads(DRIVE_CREDENTIALS_JSON)
+                _drive_credentials = service_account.Credentials.from_service_account_info(credentials_info)
+                service = build('drive', 'v3', credentials=_drive_credentials,
+                                static_discovery=True, cache_discovery=False)
+                _drive_discovery_doc = service._rootDesc
+                logging.info('Google Drive authenticated successfully.')
+        if service is None:
+            service = build_from_document(_drive_discovery_doc, credentials=_drive_credentials)
+        _drive_local.service = service
         return service
     except Exception as e:
         logging.error(f'Authentication error: {e}')
         return None
 
+
+# Indeks lokal (folder_id, nama file) -> file id Drive, disimpan ke disk agar
+# upload tidak perlu query files().list setiap kali.
+DRIVE_FILE_INDEX_PATH = os.getenv('DRIVE_FILE_INDEX_PATH', '/tmp/drive_file_index.json')
+
+_drive_file_index = None
+_drive_file_index_lock = threading.Lock()
+
+
+def _get_drive_file_index():
+    global _drive_file_index
+    if _drive_file_index is None:
+        _drive_file_index = {}
+        if os.path.exists(DRIVE_FILE_INDEX_PATH):
+            try:
+                with open(DRIVE_FILE_INDEX_PATH) as index_file:
+                    _drive_file_index = json.load(index_file)
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not read Drive file index: {e}')
+    return _drive_file_index
+
+
+def _save_drive_file_index():
+    tmp_path = f'{DRIVE_FILE_INDEX_PATH}.tmp'
+    try:
+        with open(tmp_path, 'w') as index_file:
+            json.dump(_drive_file_index, index_file)
+        os.replace(tmp_path, DRIVE_FILE_INDEX_PATH)
+    except OSError as e:
+        logging.error(f'Could not save Drive file index: {e}')
+
+
+def lookup_drive_file_id(folder_id, file_name):
+    with _drive_file_index_lock:
+        return _get_drive_file_index().get(f'{folder_id}/{file_name}')
+
+
+def remember_drive_file_id(folder_id, file_name, file_id):
+    with _drive_file_index_lock:
+        index = _get_drive_file_index()
+        if file_id is None:
+            index.pop(f'{folder_id}/{file_name}', None)
+        else:
+            index[f'{folder_id}/{file_name}'] = file_id
+        _save_drive_file_index()
+
+
 def upload_log_to_google_drive(file_path, folder_id):
     if not os.path.exists(file_path):
         logging.error(f'File {file_path} does not exist.')
-        return
+        return False
 
     logging.info(f'Uploading file {file_path} to Google Drive.')
     service = authenticate_google_drive()
 
     if service is None:
         logging.error('Google Drive service could not be authenticated.')
-        return
+        return False
 
-    file_metadata = {
-        'name': os.path.basename(file_path),
-        'parents': [folder_id]
-    }
-    media = MediaFileUpload(file_path, resumable=True)
+    file_name = os.path.basename(file_path)
 
     try:
-        # Search for existing files with the same name
-        query = f"name='{os.path.basename(file_path)}' and '{folder_id}' in parents and trashed=false"
-        existing_files = service.files().list(q=query, spaces='drive', fields='files(id)').execute().get('files', [])
+        # Jalur cepat: file id sudah diketahui dari indeks lokal
+        file_id = lookup_drive_file_id(folder_id, file_name)
+        if file_id is not None:
+            try:
+                timed_execute(service.files().update(
+                    fileId=file_id,
+                    media_body=MediaFileUpload(file_path, resumable=True)
+                ), 'files.update')
+                logging.info(f'Updated File ID: {file_id}')
+                return True
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logging.info(f'Indexed File ID {file_id} no longer exists, looking it up again.')
+                remember_drive_file_id(folder_id, file_name, None)
 
-        logging.info(f'Query result: {existing_files}')
+        # Search for existing files with the same name
+        file_id = find_drive_file(file_name, folder_id)
 
-        if existing_files:
+        if file_id is not None:
             # If file exists, update it
-            file_id = existing_files[0]['id']
-            service.files().update(
+            timed_execute(service.files().update(
                 fileId=file_id,
-                media_body=media
-            ).execute()
+                media_body=MediaFileUpload(file_path, resumable=True)
+            ), 'files.update')
             logging.info(f'Updated File ID: {file_id}')
         else:
             # If file does not exist, create a new one
-            file_metadata['parents'] = [folder_id]
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
-            logging.info(f'Created File ID: {file.get("id")}')
+            file_id = create_drive_file(file_path, file_name, folder_id)
+            if file_id is None:
+                return False
+        remember_drive_file_id(folder_id, file_name, file_id)
+        return True
+    except Exception as e:
+        logging.error(f'An error occurred during upload: {e}')
+        return False
+
+
+def find_drive_file(file_name, folder_id):
+    """Return the id of the file named file_name in folder_id, or None; raises if Drive is unavailable."""
+    service = authenticate_google_drive()
+    if service is None:
+        raise RuntimeError('Google Drive service could not be authenticated.')
+    query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
+    existing_files = timed_execute(
+        service.files().list(q=query, spaces='drive', fields='files(id)'), 'files.list').get('files', [])
+    logging.info(f'Query result for {file_name}: {existing_files}')
+    return existing_files[0]['id'] if existing_files else None
+
+
+def create_drive_file(source, file_name, folder_id, mimetype=None):
+    """Upload a local file path or an in-memory buffer to Drive as a new file; returns its id or None."""
+    service = authenticate_google_drive()
+
+    if service is None:
+        logging.error('Google Drive service could not be authenticated.')
+        return None
+
+    if isinstance(source, str):
+        media = MediaFileUpload(source, mimetype=mimetype, resumable=True)
+    else:
+        source.seek(0)
+        media = MediaIoBaseUpload(source, mimetype=mimetype, resumable=True)
+    file_metadata = {
+        'name': file_name,
+        'parents': [folder_id]
+    }
+
+    try:
+        file = timed_execute(service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id'
+        ), 'files.create')
     except Exception as e:
         logging.error(f'An error occurred during upload: {e}')
+        return None
+    logging.info(f'Created File ID: {file.get("id")}')
+    return file.get('id')
+
+
+# Folder Google Drive untuk log chat teks
+CHAT_LOG_FOLDER_ID = '1OQpqIlKPYWSvOTaXqQIOmMW3g1N0sQzf'
+# Folder Google Drive untuk arsip foto
+PHOTO_FOLDER_ID = '1l8sutMRG0bN7_p5OZHFP4vPAWEVynhZa'
+# Folder Google Drive untuk arsip stiker
+STICKER_FOLDER_ID = '1KbEpuvg0rKDJSD76oPDi_RFecEcPxFE6'
+
+# Indeks stiker yang sudah diarsipkan, dikunci file_unique_id. Stiker disimpan
+# sekali dengan nama sticker_{file_unique_id}.png; pengiriman ulang hanya
+# dicatat sebagai referensi. Indeks ditulis append-only ke disk dan dibaca
+# ulang saat startup.
+STICKER_INDEX_PATH = os.getenv('STICKER_INDEX_PATH', '/tmp/sticker_index.jsonl')
+
+_sticker_index = {}  # file_unique_id -> nama file di Drive
+_sticker_pending = set()  # sudah diantrikan tapi belum selesai diunggah
+_sticker_index_lock = threading.Lock()
+sticker_stats = {'archived': 0, 'repeats': 0}
+
+
+def sticker_archive_name(file_unique_id):
+    return f'sticker_{file_unique_id}.png'
+
+
+def load_sticker_index():
+    """Warm the sticker seen-set from the on-disk snapshot."""
+    entries = {}
+    if os.path.exists(STICKER_INDEX_PATH):
+        try:
+            with open(STICKER_INDEX_PATH) as index_file:
+                for line in index_file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        entries[entry['id']] = entry['name']
+        except (OSError, ValueError) as e:
+            logging.error(f'Could not read sticker index: {e}')
+    with _sticker_index_lock:
+        _sticker_index.update(entries)
+    logging.info(f'Loaded {len(entries)} archived stickers.')
+
+
+def claim_sticker(file_unique_id):
+    """Return True if the sticker still has to be archived (and reserve it), False if it is known."""
+    with _sticker_index_lock:
+        if file_unique_id in _sticker_index or file_unique_id in _sticker_pending:
+            sticker_stats['repeats'] += 1
+            return False
+        _sticker_pending.add(file_unique_id)
+        return True
+
+
+def release_sticker(file_unique_id):
+    # Arsip gagal permanen: stiker boleh dicoba lagi saat dikirim berikutnya
+    with _sticker_index_lock:
+        _sticker_pending.discard(file_unique_id)
+
+
+def remember_sticker(file_unique_id, name):
+    with _sticker_index_lock:
+        _sticker_pending.discard(file_unique_id)
+        _sticker_index[file_unique_id] = name
+        sticker_stats['archived'] += 1
+        try:
+            with open(STICKER_INDEX_PATH, 'a') as index_file:
+                index_file.write(json.dumps({'id': file_unique_id, 'name': name}) + '\n')
+        except OSError as e:
+            logging.error(f'Could not save sticker index: {e}')
+
+
+# Log chat ditulis sebagai segmen terkompresi (lihat "Pengelola Pesan").
+# Thread uploader berkala mengompres blok yang terlalu lama tertahan di
+# memori dan menutup segmen yang sudah tua; segmen tertutup diunggah sekali.
+LOG_UPLOAD_INTERVAL = float(os.getenv('LOG_UPLOAD_INTERVAL', '60'))
+
+_log_uploader_stop = threading.Event()
+_log_uploader_thread = None
+log_upload_stats = {'submitted': 0}
+
+
+def _log_uploader_loop():
+    while not _log_uploader_stop.wait(LOG_UPLOAD_INTERVAL):
+        try:
+            maintain_log_segments()
+        except Exception as e:
+            logging.error(f'Log segment maintenance failed: {e}')
+
+
+def start_log_uploader():
+    global _log_uploader_thread
+    _log_uploader_thread = threading.Thread(target=_log_uploader_loop, name='log-uploader', daemon=True)
+    _log_uploader_thread.start()
+
+
+def stop_log_uploader():
+    """Stop the background uploader, then seal and upload every open log segment."""
+    _log_uploader_stop.set()
+    if _log_uploader_thread is not None:
+        _log_uploader_thread.join()
+    sealed = seal_all_log_segments()
+    logging.info(f'Sealed {sealed} open log segments before shutdown.')
+
+
+# Pipeline arsip: semua upload (Drive dan Firebase Storage) dikerjakan oleh
+# thread pool terpisah dari antrian berukuran terbatas. Handler hanya
+# memasukkan job lalu langsung kembali. Job berupa dict yang bisa di-JSON-kan
+# agar bisa di-spool ke disk saat antrian penuh dan di-retry dengan backoff.
+ARCHIVE_WORKERS = int(os.getenv('ARCHIVE_WORKERS', '4'))
+ARCHIVE_QUEUE_SIZE = int(os.getenv('ARCHIVE_QUEUE_SIZE', '1000'))
+ARCHIVE_MAX_ATTEMPTS = int(os.getenv('ARCHIVE_MAX_ATTEMPTS', '5'))
+ARCHIVE_RETRY_BASE_DELAY = float(os.getenv('ARCHIVE_RETRY_BASE_DELAY', '2'))
+ARCHIVE_SPOOL_PATH = os.getenv('ARCHIVE_SPOOL_PATH', '/tmp/archive_spool.jsonl')
+ARCHIVE_SHUTDOWN_TIMEOUT = float(os.getenv('ARCHIVE_SHUTDOWN_TIMEOUT', '20'))
+# Voice note dialirkan dari Telegram lewat buffer terbatas (di memori, baru
+# tumpah ke direktori temp sistem jika lebih besar) ke upload Storage per chunk
+VOICE_BUFFER_MAX_BYTES = int(os.getenv('VOICE_BUFFER_MAX_BYTES', str(1024 * 1024)))
+VOICE_UPLOAD_CHUNK_SIZE = 256 * 1024  # Harus kelipatan 256 KB
+VOICE_DOWNLOAD_TIMEOUT = float(os.getenv('VOICE_DOWNLOAD_TIMEOUT', '30'))
+
+# Bot yang dipakai job untuk mengunduh file dari Telegram (diisi di main)
+archive_bot = None
+
+_archive_queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+_archive_workers = []
+_archive_scheduler_thread = None
+_archive_retry_heap = []  # (waktu retry, urutan, job)
+_archive_cond = threading.Condition()
+_archive_spool_lock = threading.Lock()
+_archive_stopping = False
+_archive_stats_lock = threading.Lock()  # Penghitung diubah dari thread handler dan worker
+archive_stats = {'enqueued': 0, 'completed': 0, 'failed': 0, 'retried': 0, 'spooled': 0,
+                 'latency_total': 0.0, 'latency_max': 0.0}
+
+
+def _archive_drive_log(file_path, folder_id):
+    # Hanya untuk job lama di spool; segmen baru memakai drive_segment
+    if not upload_log_to_google_drive(file_path, folder_id):
+        raise RuntimeError(f'Upload of {file_path} failed')
+
+
+def _archive_drive_segment(file_path, folder_id, file_name=None):
+    # Nama di Drive memuat id boot proses sehingga selalu baru; file langsung
+    # dibuat tanpa files.list (file_name kosong hanya untuk job lama di spool)
+    if not os.path.exists(file_path):
+        logging.error(f'File {file_path} does not exist.')
+        return
+    if create_drive_file(file_path, file_name or os.path.basename(file_path), folder_id) is None:
+        raise RuntimeError(f'Upload of {file_path} failed')
+
+
+def _archive_drive_photo(user_id, file_id):
+    photo_buffer = io.BytesIO()
+    download_telegram_file(archive_bot, file_id, out=photo_buffer)
+    if create_drive_file(photo_buffer, f'{user_id}_photo_{file_id}.jpg', PHOTO_FOLDER_ID, 'image/jpeg') is None:
+        raise RuntimeError(f'Upload of photo {file_id} failed')
+
+
+def _archive_drive_sticker(user_id, file_id, file_unique_id=None):
+    # Job lama di spool belum punya file_unique_id: pakai nama per pengguna
+    name = sticker_archive_name(file_unique_id) if file_unique_id else f'{user_id}_sticker_{file_id}.png'
+    if file_unique_id and find_drive_file(name, STICKER_FOLDER_ID) is not None:
+        # Indeks stiker per worker: stiker ini sudah diarsipkan worker lain atau sebelum restart
+        remember_sticker(file_unique_id, name)
+        return
+    sticker_buffer = io.BytesIO()
+    download_telegram_file(archive_bot, file_id, out=sticker_buffer)
+    if create_drive_file(sticker_buffer, name, STICKER_FOLDER_ID, 'image/png') is None:
+        raise RuntimeError(f'Upload of sticker {file_id} failed')
+    if file_unique_id:
+        remember_sticker(file_unique_id, name)
+
+
+def _archive_storage_voice(file_id, file_unique_id=None, filename=None):
+    # Nama blob mengikuti file_unique_id agar voice note yang diteruskan ulang
+    # hanya disimpan sekali (filename hanya untuk job lama di spool)
+    blob = get_bucket().blob(f'voice_notes/{file_unique_id}.ogg' if file_unique_id else f'voice_notes/{filename}',
+                             chunk_size=VOICE_UPLOAD_CHUNK_SIZE)
+    with observe_backend('storage', 'blob.exists'):
+        if blob.exists():
+            return
+
+    with tempfile.SpooledTemporaryFile(max_size=VOICE_BUFFER_MAX_BYTES) as voice_buffer:
+        size = stream_telegram_file(archive_bot, file_id, voice_buffer)
+        voice_buffer.seek(0)
+        with observe_backend('storage', 'blob.upload'):
+            blob.upload_from_file(voice_buffer, size=size, content_type='audio/ogg')
+
+
+def _archive_storage_profile_photo(user_id, file_id, file_unique_id=None):
+    photo_buffer = io.BytesIO()
+    download_telegram_file(archive_bot, file_id, out=photo_buffer)
+
+    # Unggah gambar ke Firebase Storage (content-addressed)
+    profile_photo_url, file_hash = upload_profile_photo(photo_buffer)
+
+    # Update Firestore dengan URL foto profil dan metadata foto terakhir
+    update_last_photo_metadata(user_id, file_id, file_unique_id, profile_photo_url, file_hash,
+                               photo=profile_photo_url)
+
+
+def download_telegram_file(bot, file_id, **kwargs):
+    # getFile sudah dihitung oleh InstrumentedBot; unduhan file dihitung di sini
+    file = bot.get_file(file_id)
+    with observe_backend('telegram', 'download'):
+        return file.download(**kwargs)
+
+
+def stream_telegram_file(bot, file_id, out):
+    """Copy a Telegram file into out chunk by chunk; returns the number of bytes written."""
+    file = bot.get_file(file_id)
+    with observe_backend('telegram', 'download'):
+        with urllib.request.urlopen(file.file_path, timeout=VOICE_DOWNLOAD_TIMEOUT) as response:
+            shutil.copyfileobj(response, out, VOICE_UPLOAD_CHUNK_SIZE)
+    return out.tell()
+
+
+ARCHIVE_JOB_KINDS = {
+    'drive_log': _archive_drive_log,
+    'drive_segment': _archive_drive_segment,
+    'drive_photo': _archive_drive_photo,
+    'drive_sticker': _archive_drive_sticker,
+    'storage_voice': _archive_storage_voice,
+    'storage_profile_photo': _archive_storage_profile_photo,
+}
+
+
+def _spool_archive_jobs(jobs):
+    with _archive_spool_lock:
+        with open(ARCHIVE_SPOOL_PATH, 'a') as spool_file:
+            for job in jobs:
+                spool_file.write(json.dumps(job) + '\n')
+        archive_stats['spooled'] += len(jobs)
+
+
+def _enqueue_archive_job(job):
+    try:
+        _archive_queue.put_nowait(job)
+    except queue.Full:
+        # Antrian penuh: simpan ke disk, akan dimasukkan lagi saat ada ruang
+        _spool_archive_jobs([job])
+
+
+def submit_archive_job(kind, **args):
+    """Queue an archival job and return immediately."""
+    job = {'kind': kind, 'args': args, 'attempt': 0, 'enqueued_at': time.time()}
+    with _archive_stats_lock:
+        archive_stats['enqueued'] += 1
+    _enqueue_archive_job(job)
+
 
+def _drain_archive_spool():
+    # Pindahkan job dari spool ke antrian selama masih ada ruang
+    with _archive_spool_lock:
+        if archive_stats['spooled'] == 0 or not os.path.exists(ARCHIVE_SPOOL_PATH):
+            return
+        with open(ARCHIVE_SPOOL_PATH) as spool_file:
+            jobs = [json.loads(line) for line in spool_file if line.strip()]
+        remaining = []
+        for job in jobs:
+            if remaining:
+                remaining.append(job)
+                continue
+            try:
+                _archive_queue.put_nowait(job)
+            except queue.Full:
+                remaining.append(job)
+        tmp_path = f'{ARCHIVE_SPOOL_PATH}.tmp'
+        with open(tmp_path, 'w') as spool_file:
+            for job in remaining:
+                spool_file.write(json.dumps(job) + '\n')
+        os.replace(tmp_path, ARCHIVE_SPOOL_PATH)
+        archive_stats['spooled'] = len(remaining)
+
+
+def _schedule_archive_retry(job):
+    delay = ARCHIVE_RETRY_BASE_DELAY * (2 ** (job['attempt'] - 1)) * random.uniform(0.8, 1.2)
+    with _archive_cond:
+        if _archive_stopping:
+            _spool_archive_jobs([job])
+            return
+        heapq.heappush(_archive_retry_heap, (time.monotonic() + delay, id(job), job))
+        with _archive_stats_lock:
+            archive_stats['retried'] += 1
+        _archive_cond.notify()
+
+
+def _archive_worker_loop():
+    while True:
+        job = _archive_queue.get()
+        try:
+            if job is None:
+                return
+            handler = ARCHIVE_JOB_KINDS[job['kind']]
+            try:
+                handler(**job['args'])
+            except Exception as e:
+                job['attempt'] += 1
+                if job['attempt'] < ARCHIVE_MAX_ATTEMPTS:
+                    logging.warning(f"Archive job {job['kind']} failed (attempt {job['attempt']}): {e}")
+                    _schedule_archive_retry(job)
+                else:
+                    logging.error(f"Archive job {job['kind']} gave up after {job['attempt']} attempts: {e}")
+                    with _archive_stats_lock:
+                        archive_stats['failed'] += 1
+                    if job['kind'] == 'drive_sticker' and job['args'].get('file_unique_id'):
+                        release_sticker(job['args']['file_unique_id'])
+                    elif job['kind'] == 'storage_voice' and job['args'].get('file_unique_id'):
+                        release_voice(job['args']['file_unique_id'])
+                continue
+            latency = time.time() - job['enqueued_at']
+            with _archive_stats_lock:
+                archive_stats['completed'] += 1
+                archive_stats['latency_total'] += latency
+                archive_stats['latency_max'] = max(archive_stats['latency_max'], latency)
+        finally:
+            _archive_queue.task_done()
+            if archive_stats['spooled']:
+                # Ada ruang di antrian, bangunkan scheduler untuk menarik spool
+                with _archive_cond:
+                    _archive_cond.notify()
+
+
+def _archive_scheduler_loop():
+    # Memasukkan job retry yang sudah jatuh tempo dan job dari spool
+    while True:
+        with _archive_cond:
+            if _archive_stopping:
+                return
+            timeout = 1.0
+            if _archive_retry_heap:
+                timeout = min(timeout, max(0.0, _archive_retry_heap[0][0] - time.monotonic()))
+            _archive_cond.wait(timeout)
+            if _archive_stopping:
+                return
+            due = []
+            while _archive_retry_heap and _archive_retry_heap[0][0] <= time.monotonic():
+                due.append(heapq.heappop(_archive_retry_heap)[2])
+        for job in due:
+            _enqueue_archive_job(job)
+        _drain_archive_spool()
+
+
+def start_archive_pipeline(bot):
+    global archive_bot, _archive_scheduler_thread
+    archive_bot = bot
+    if os.path.exists(ARCHIVE_SPOOL_PATH):
+        with open(ARCHIVE_SPOOL_PATH) as spool_file:
+            archive_stats['spooled'] = sum(1 for line in spool_file if line.strip())
+    for index in range(ARCHIVE_WORKERS):
+        worker = threading.Thread(target=_archive_worker_loop, name=f'archive-worker-{index}', daemon=True)
+        worker.start()
+        _archive_workers.append(worker)
+    _archive_scheduler_thread = threading.Thread(target=_archive_scheduler_loop, name='archive-scheduler', daemon=True)
+    _archive_scheduler_thread.start()
+
+
+def stop_archive_pipeline():
+    """Drain the archive queue; jobs still pending after the timeout are spooled for the next start."""
+    global _archive_stopping
+    with _archive_cond:
+        _archive_stopping = True
+        _archive_cond.notify_all()
+        pending_retries = [entry[2] for entry in _archive_retry_heap]
+        _archive_retry_heap.clear()
+    if _archive_scheduler_thread is not None:
+        _archive_scheduler_thread.join()
+    if pending_retries:
+        _spool_archive_jobs(pending_retries)
+
+    deadline = time.monotonic() + ARCHIVE_SHUTDOWN_TIMEOUT
+    while _archive_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    leftover = []
+    while True:
+        try:
+            leftover.append(_archive_queue.get_nowait())
+            _archive_queue.task_done()
+        except queue.Empty:
+            break
+    if leftover:
+        logging.info(f'Spooling {len(leftover)} unfinished archive jobs.')
+        _spool_archive_jobs(leftover)
+
+    for _ in _archive_workers:
+        _archive_queue.put(None)
+
+
+def get_archive_pipeline_stats():
+    with _archive_stats_lock:
+        stats = dict(archive_stats)
+    completed = stats['completed']
+    with _archive_cond:
+        retry_pending = len(_archive_retry_heap)
+    return dict(stats,
+                queue_depth=_archive_queue.qsize(),
+                retry_pending=retry_pending,
+                latency_avg=(stats['latency_total'] / completed) if completed else 0.0)
+
+
+# State backend untuk antrian tunggu, sesi aktif dan daftar banned. Firestore
+# (default) untuk deployment multi-instance; memory untuk satu instance,
+# benchmark dan pengujian, dengan snapshot opsional ke file lokal; file untuk
+# beberapa worker di satu host (dan pengujian multi-proses tanpa cloud).
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'firestore')
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH')
+STATE_SNAPSHOT_INTERVAL = float(os.getenv('STATE_SNAPSHOT_INTERVAL', '30'))
+STATE_FILE_PATH = os.getenv('STATE_FILE_PATH', '/tmp/bot_state.json')
+STATE_POLL_INTERVAL = float(os.getenv('STATE_POLL_INTERVAL', '0.5'))
+
+# Identitas worker. Dengan lebih dari satu worker, kandidat pasangan di-lease
+# dulu di store bersama sehingga worker lain melewatinya, dan cache sesi
+# diperbarui dari perubahan yang dibuat worker lain.
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '1'))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+WORKER_ID = os.getenv('WORKER_ID') or f'{os.uname().nodename}:{os.getpid()}'
+MATCH_LEASE_TTL = float(os.getenv('MATCH_LEASE_TTL', '10'))
+
+
+def _lease_available(entry: dict, owner) -> bool:
+    # Lease bebas jika belum ada, milik worker ini, atau sudah kedaluwarsa
+    return entry.get('lease_owner') in (None, owner) or entry.get('lease_until', 0) < time.time()
+
+
+def _write_pair(writer, user_id: str, partner_id: str):
+    # writer bisa berupa WriteBatch atau Transaction
+    writer.delete(get_db().collection('waiting_users').document(user_id))
+    writer.delete(get_db().collection('waiting_users').document(partner_id))
+    writer.set(get_db().collection('active_chats').document(user_id), {'partner': partner_id})
+    writer.set(get_db().collection('active_chats').document(partner_id), {'partner': int(user_id)})
+
+
+@firestore.transactional
+def _claim_pair(transaction, user_id: str, partner_id: str, owner=None) -> bool:
+    partner_waiting_ref = get_db().collection('waiting_users').document(partner_id)
+    user_chat_ref = get_db().collection('active_chats').document(user_id)
+    partner_waiting = partner_waiting_ref.get(transaction=transaction)
+    if not partner_waiting.exists or not _lease_available(partner_waiting.to_dict(), owner):
+        return False  # Sudah diklaim oleh proses lain
+    if user_chat_ref.get(transaction=transaction).exists:
+        return False  # Pengguna sudah dipasangkan oleh worker lain
+
+    _write_pair(transaction, user_id, partner_id)
+    return True
+
+
+@firestore.transactional
+def _lease_waiting(transaction, user_id: str, owner: str) -> bool:
+    waiting_ref = get_db().collection('waiting_users').document(user_id)
+    waiting = waiting_ref.get(transaction=transaction)
+    if not waiting.exists or not _lease_available(waiting.to_dict(), owner):
+        return False
+    transaction.update(waiting_ref, {'lease_owner': owner, 'lease_until': time.time() + MATCH_LEASE_TTL})
+    return True
+
+
+class FirestoreStateBackend:
+    """Session state in the waiting_users, active_chats and banned_users collections."""
+
+    name = 'firestore'
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def load_waiting(self):
+        with observe_backend('firestore', 'waiting_users.stream'):
+            return [doc.id for doc in get_db().collection('waiting_users').stream()]
+
+    def add_waiting(self, user_id: str):
+        with observe_backend('firestore', 'waiting_users.set'):
+            get_db().collection('waiting_users').document(user_id).set({'enqueued_at': firestore.SERVER_TIMESTAMP})
+
+    def get_partner(self, user_id: str):
+        with observe_backend('firestore', 'active_chats.get'):
+            chat = get_db().collection('active_chats').document(user_id).get()
+        return chat.to_dict().get('partner') if chat.exists else None
+
+    def lease_waiting(self, user_id: str, owner: str) -> bool:
+        with observe_backend('firestore', 'transaction.lease_waiting'):
+            return _lease_waiting(get_db().transaction(), user_id, owner)
+
+    def claim_pair(self, user_id: str, partner_id: str, owner=None) -> bool:
+        with observe_backend('firestore', 'transaction.claim_pair'):
+            return _claim_pair(get_db().transaction(), user_id, partner_id, owner)
+
+    def unpair(self, user_id: str, partner_id: str):
+        batch = get_db().batch()
+        batch.delete(get_db().collection('active_chats').document(user_id))
+        batch.delete(get_db().collection('active_chats').document(partner_id))
+        with observe_backend('firestore', 'batch.unpair'):
+            batch.commit()
+
+    def ban(self, target_id: str, user_data: dict, partner_id=None):
+        batch = get_db().batch()
+        batch.set(get_db().collection('banned_users').document(target_id), user_data)
+        batch.delete(get_db().collection('users').document(target_id))
+        batch.delete(get_db().collection('waiting_users').document(target_id))
+        batch.delete(get_db().collection('active_chats').document(target_id))
+        if partner_id is not None:
+            batch.delete(get_db().collection('active_chats').document(partner_id))
+        with observe_backend('firestore', 'batch.ban'):
+            batch.commit()
+
+    def unban(self, target_id: str, user_data: dict):
+        batch = get_db().batch()
+        batch.set(get_db().collection('users').document(target_id), user_data)
+        batch.delete(get_db().collection('banned_users').document(target_id))
+        with observe_backend('firestore', 'batch.unban'):
+            batch.commit()
+
+    def get_banned(self, user_id: str):
+        with observe_backend('firestore', 'banned_users.get'):
+            doc = get_db().collection('banned_users').document(user_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def list_banned(self):
+        document_id = FieldPath.document_id()
+        with observe_backend('firestore', 'banned_users.stream'):
+            return [doc.id for doc in get_db().collection('banned_users').select([document_id]).stream()]
+
+    def watch_banned(self, on_change):
+        """Call on_change(added, removed) for every change of banned_users; returns an unsubscribe function."""
+        first_snapshot = threading.Event()
+
+        def on_banned_snapshot(docs, changes, read_time):
+            on_change([change.document.id for change in changes if change.type.name != 'REMOVED'],
+                      [change.document.id for change in changes if change.type.name == 'REMOVED'])
+            first_snapshot.set()
+
+        watch = get_db().collection('banned_users').on_snapshot(on_banned_snapshot)
+        if not first_snapshot.wait(BANNED_LISTENER_TIMEOUT):
+            # Listener lambat, muat sekali secara langsung
+            on_change(self.list_banned(), [])
+        return watch.unsubscribe
+
+    def watch_sessions(self, on_change):
+        """Call on_change('active', user_id, partner_or_None) / on_change('waiting', user_id, bool) on every change."""
+        def on_active_snapshot(docs, changes, read_time):
+            for change in changes:
+                partner_id = None if change.type.name == 'REMOVED' else change.document.to_dict().get('partner')
+                on_change('active', change.document.id, partner_id)
+
+        def on_waiting_snapshot(docs, changes, read_time):
+            for change in changes:
+                if change.type.name != 'MODIFIED':  # MODIFIED hanya perubahan lease
+                    on_change('waiting', change.document.id, change.type.name == 'ADDED')
+
+        watches = [get_db().collection('active_chats').on_snapshot(on_active_snapshot),
+                   get_db().collection('waiting_users').on_snapshot(on_waiting_snapshot)]
+        return lambda: [watch.unsubscribe() for watch in watches]
+
+
+class MemoryStateBackend:
+    """In-process session state for a single instance, optionally snapshotted to a JSON file."""
+
+    name = 'memory'
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self._lock = threading.RLock()
+        self._waiting = {}  # user_id -> {enqueued_at, lease_owner, lease_until} (urutan dict = FIFO)
+        self._active = {}  # user_id -> partner_id
+        self._dirty = False
+        self._stopping = threading.Event()
+        self._snapshot_thread = None
+        if snapshot_path and os.path.exists(snapshot_path):
+            with open(snapshot_path) as snapshot_file:
+                self._load_state(json.load(snapshot_file))
+            logging.info(f'Loaded state snapshot from {snapshot_path}: {len(self._waiting)} waiting, '
+                         f'{len(self._active)} in chat.')
+
+    def _load_state(self, state):
+        self._waiting = state.get('waiting', {})
+        self._active = state.get('active', {})
+
+    def _dump_state(self):
+        return {'waiting': dict(self._waiting), 'active': dict(self._active)}
+
+    def start(self):
+        if self.snapshot_path and self._snapshot_thread is None:
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop, name='state-snapshot', daemon=True)
+            self._snapshot_thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        self.save_snapshot()
+
+    def _snapshot_loop(self):
+        while not self._stopping.wait(STATE_SNAPSHOT_INTERVAL):
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            state = self._dump_state()
+            self._dirty = False
+        try:
+            tmp_path = f'{self.snapshot_path}.tmp'
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump(state, snapshot_file, default=str)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logging.error(f'Failed to write state snapshot {self.snapshot_path}: {e}')
+            with self._lock:
+                self._dirty = True
+
+    def load_waiting(self):
+        with self._lock:
+            return list(self._waiting)
+
+    def add_waiting(self, user_id: str):
+        with self._lock:
+            self._waiting.setdefault(user_id, {'enqueued_at': time.time()})
+            self._dirty = True
+
+    def get_partner(self, user_id: str):
+        with self._lock:
+            return self._active.get(user_id)
+
+    def _set_pair(self, user_id, partner_id):
+        # Dipanggil dengan self._lock
+        self._waiting.pop(user_id, None)
+        self._waiting.pop(partner_id, None)
+        self._active[user_id] = partner_id
+        self._active[partner_id] = user_id
+        self._dirty = True
+
+    def lease_waiting(self, user_id: str, owner: str) -> bool:
+        with self._lock:
+            entry = self._waiting.get(user_id)
+            if entry is None or not _lease_available(entry, owner):
+                return False
+            entry.update(lease_owner=owner, lease_until=time.time() + MATCH_LEASE_TTL)
+            self._dirty = True
+            return True
+
+    def claim_pair(self, user_id: str, partner_id: str, owner=None) -> bool:
+        with self._lock:
+            entry = self._waiting.get(partner_id)
+            if entry is None or not _lease_available(entry, owner):
+                return False  # Sudah diklaim
+            if user_id in self._active:
+                return False  # Pengguna sudah dipasangkan
+            self._set_pair(user_id, partner_id)
+            return True
+
+    def unpair(self, user_id: str, partner_id: str):
+        with self._lock:
+            self._active.pop(user_id, None)
+            self._active.pop(partner_id, None)
+            self._dirty = True
+
+    def ban(self, target_id: str, user_data: dict, partner_id=None):
+        # Profil dan daftar ban tetap di Firestore, hanya state sesi yang di memori
+        batch = get_db().batch()
+        batch.set(get_db().collection('banned_users').document(target_id), user_data)
+        batch.delete(get_db().collection('users').document(target_id))
+        with observe_backend('firestore', 'batch.ban'):
+            batch.commit()
+        self._drop_session(target_id, partner_id)
+
+    def _drop_session(self, target_id, partner_id):
+        with self._lock:
+            self._waiting.pop(target_id, None)
+            self._active.pop(target_id, None)
+            if partner_id is not None:
+                self._active.pop(partner_id, None)
+            self._dirty = True
+
+    unban = FirestoreStateBackend.unban
+    get_banned = FirestoreStateBackend.get_banned
+    list_banned = FirestoreStateBackend.list_banned
+    watch_banned = FirestoreStateBackend.watch_banned
+
+    def watch_sessions(self, on_change):
+        # Satu proses: semua perubahan sesi sudah terlihat di cache lokal
+        return lambda: None
+
+
+class FileStateBackend(MemoryStateBackend):
+    """State shared by the worker processes of one host through a JSON file guarded by flock."""
+
+    name = 'file'
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._lock_path = f'{path}.lock'
+        self._shared_depth = 0
+        self._session_watchers = []
+        self._seen = None
+        self._seen_mtime = None
+        self._poll_thread = None
+
+    @contextmanager
+    def _shared_state(self, write=True):
+        # Kunci antar-thread lalu antar-proses; state dibaca ulang dari file setiap
+        # operasi. Pemanggilan bersarang memakai kunci dan state milik pemanggil luar.
+        with self._lock:
+            if self._shared_depth:
+                self._shared_depth += 1
+                try:
+                    yield
+                finally:
+                    self._shared_depth -= 1
+                return
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+                self._shared_depth = 1
+                try:
+                    try:
+                        with open(self.path) as state_file:
+                            self._load_state(json.load(state_file))
+                    except FileNotFoundError:
+                        self._load_state({})
+                    yield
+                    if write and self._dirty:
+                        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+                        with open(tmp_path, 'w') as state_file:
+                            json.dump(self._dump_state(), state_file, default=str)
+                        os.replace(tmp_path, self.path)
+                        self._dirty = False
+                finally:
+                    self._shared_depth = 0
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def start(self):
+        with self._shared_state(write=False):
+            self._seen = self._dump_state()
+        if self._poll_thread is None:
+            self._poll_thread = threading.Thread(target=self._poll_loop, name='state-poll', daemon=True)
+            self._poll_thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+
+    def _poll_loop(self):
+        while not self._stopping.wait(STATE_POLL_INTERVAL):
+            try:
+                self._poll_changes()
+            except Exception as e:
+                logging.error(f'Failed to poll state file {self.path}: {e}')
+
+    def _poll_changes(self):
+        # Bandingkan isi file dengan yang terakhir dilihat dan laporkan selisihnya
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._seen_mtime:
+            return
+        with self._shared_state(write=False):
+            current = self._dump_state()
+        previous, self._seen, self._seen_mtime = self._seen or self._dump_state(), current, mtime
+
+        session_changes = [('active', user_id, current['active'].get(user_id))
+                           for user_id in previous['active'].keys() | current['active'].keys()
+                           if previous['active'].get(user_id) != current['active'].get(user_id)]
+        session_changes += [('waiting', user_id, user_id in current['waiting'])
+                            for user_id in previous['waiting'].keys() ^ current['waiting'].keys()]
+
+        for on_change in list(self._session_watchers):
+            for change in session_changes:
+                on_change(*change)
+
+    def save_snapshot(self):
+        pass  # File ini sendiri adalah state-nya
+
+    def load_waiting(self):
+        with self._shared_state(write=False):
+            return super().load_waiting()
+
+    def add_waiting(self, user_id: str):
+        with self._shared_state():
+            super().add_waiting(user_id)
 
+    def get_partner(self, user_id: str):
+        with self._shared_state(write=False):
+            return super().get_partner(user_id)
+
+    def lease_waiting(self, user_id: str, owner: str) -> bool:
+        with self._shared_state():
+            return super().lease_waiting(user_id, owner)
+
+    def claim_pair(self, user_id: str, partner_id: str, owner=None) -> bool:
+        with self._shared_state():
+            return super().claim_pair(user_id, partner_id, owner)
+
+    def unpair(self, user_id: str, partner_id: str):
+        with self._shared_state():
+            super().unpair(user_id, partner_id)
+
+    def _drop_session(self, target_id, partner_id):
+        with self._shared_state():
+            super()._drop_session(target_id, partner_id)
+
+    def watch_sessions(self, on_change):
+        self._session_watchers.append(on_change)
+        return lambda: self._session_watchers.remove(on_change)
+
+
+STATE_BACKENDS = {
+    'firestore': FirestoreStateBackend,
+    'memory': lambda: MemoryStateBackend(STATE_SNAPSHOT_PATH),
+    'file': lambda: FileStateBackend(STATE_FILE_PATH),
+}
+
+
+def create_state_backend(kind=None):
+    kind = kind or STATE_BACKEND
+    if kind not in STATE_BACKENDS:
+        raise ValueError(f"Unknown STATE_BACKEND '{kind}', expected one of {', '.join(STATE_BACKENDS)}")
+    if kind == 'memory' and WORKER_COUNT > 1:
+        raise ValueError('STATE_BACKEND=memory cannot be shared between workers, use file or firestore')
+    logging.info(f'Using {kind} state backend.')
+    return STATE_BACKENDS[kind]()
+
+
+state_backend = create_state_backend()
+
+
+# Daftar pengguna ter-banned disimpan di memori dan diperbarui oleh snapshot
+# listener, sehingga pengecekan ban tidak perlu membaca Firestore.
+BANNED_MESSAGE = "Anda telah dibanned dan tidak dapat mendaftar lagi. Silakan hubungi kontak admin@bot.unnes kirimkan email dan kirimkan bukti skrinshot tanggal terakhir kali anda di banned untuk melakukan banding dan pengecekan terkait."
+BANNED_LISTENER_TIMEOUT = float(os.getenv('BANNED_LISTENER_TIMEOUT', '10'))
+
+_banned_ids = set()
+_banned_lock = threading.Lock()
+_banned_unsubscribe = None
+
+
+def is_banned(user_id) -> bool:
+    with _banned_lock:
+        return str(user_id) in _banned_ids
+
+
+def mark_banned(user_id, banned=True):
+    with _banned_lock:
+        if banned:
+            _banned_ids.add(str(user_id))
+        else:
+            _banned_ids.discard(str(user_id))
+
+
+def load_banned_users():
+    """Load the banned users once and keep the set fresh through the state backend's watch."""
+    global _banned_unsubscribe
+
+    def on_banned_change(added, removed):
+        with _banned_lock:
+            _banned_ids.update(added)
+            _banned_ids.difference_update(removed)
+
+    _banned_unsubscribe = state_backend.watch_banned(on_banned_change)
+    logging.info(f'Loaded {len(_banned_ids)} banned users.')
+
+
+def stop_banned_listener():
+    if _banned_unsubscribe is not None:
+        _banned_unsubscribe()
+
+
+def reject_banned_user(update: Update, context: CallbackContext):
+    # Dijalankan sebelum semua handler lain (group -1)
+    user = update.effective_user
+    if user is None or not is_banned(user.id):
+        return
+    if update.callback_query:
+        update.callback_query.answer()
+    try:
+        context.bot.send_message(chat_id=user.id, text=BANNED_MESSAGE)
+    except Exception as e:
+        logging.error(f"Failed to send banned notice to {user.id}: {e}")
+    raise DispatcherHandlerStop()
 
 
 def start(update: Update, context: CallbackContext):
@@ -127,40 +1414,34 @@ def start(update: Update, context: CallbackContext):
     username = user.username or "Tidak ada username"
 
     # Periksa apakah pengguna ter-banned
-    banned_user_ref = db.collection('banned_users').document(str(user_id))
-    if banned_user_ref.get().exists:
+    if is_banned(user_id):
         try:
             context.bot.send_message(
                 chat_id=user_id,
-                text="Anda telah dibanned dan tidak dapat mendaftar lagi. Silakan hubungi kontak admin@bot.unnes kirimkan email dan kirimkan bukti skrinshot tanggal terakhir kali anda di banned untuk melakukan banding dan pengecekan terkait."
+                text=BANNED_MESSAGE
             )
         except Exception as e:
             print(f"Failed to send message: {e}")
         return
 
-    # Simpan pengguna ke Firestore tanpa foto
-    user_doc_ref = db.collection('users').document(str(user_id))
-    user_doc_ref.set({
-        'username': username,
-        'photo': None,
-        'status': 'registered'
-    })
-
-    # Ambil dan simpan foto profil jika tersedia
+    # Simpan pengguna ke Firestore tanpa foto; merge agar array history tetap ada
+    user_doc_ref = get_db().collection('users').document(str(user_id))
+    with observe_backend('firestore', 'users.set'):
+        user_doc_ref.set({
+            'username': username,
+            'photo': None,
+            'status': 'registered'
+        }, merge=True)
+    forget_last_photo_metadata(user_id)
+    forget_user_info(user_id)
+
+    # Ambil foto profil jika tersedia; unggahan dikerjakan pipeline arsip
     try:
-        profile_photos = context.bot.get_user_profile_photos(user_id)
+        profile_photos = context.bot.get_user_profile_photos(user_id, limit=1)
         if profile_photos.total_count > 0:
-            photo_id = profile_photos.photos[0][-1].file_id
-            file = context.bot.get_file(photo_id)
-            file.download('profile_photo.jpg')
-
-            # Unggah gambar ke Firebase Storage
-            blob = bucket.blob(f'profile_photos/{user_id}.jpg')
-            blob.upload_from_filename('profile_photo.jpg')
-            profile_photo_url = blob.public_url
-
-            # Update Firestore dengan URL foto profil
-            user_doc_ref.update({'photo': profile_photo_url})
+            photo = profile_photos.photos[0][-1]
+            submit_archive_job('storage_profile_photo', user_id=user_id, file_id=photo.file_id,
+                               file_unique_id=photo.file_unique_id)
     except Exception as e:
         print(f"Failed to handle profile photo: {e}")
 
@@ -188,99 +1469,411 @@ def start(update: Update, context: CallbackContext):
 # Untuk Mengetahui Update Riwayat Rekam jejak User
 import hashlib
 
-def update_user_info(user_id: str, username: str, photo_url: str):
-    # Referensi ke dokumen pengguna di koleksi utama
-    user_doc_ref = db.collection('users').document(str(user_id))
-    user_doc_ref.update({'username': username, 'photo': photo_url})
-
-    # Referensi ke subkoleksi riwayat pengguna
-    history_ref = user_doc_ref.collection('history')
-    
-    # Tambahkan entri riwayat baru dengan timestamp
-    history_ref.add({
+# Riwayat disimpan sebagai array berukuran tetap di dokumen pengguna
+USER_HISTORY_LIMIT = 5
+
+# Username dan foto terakhir yang diketahui per pengguna, untuk melewati
+# penulisan jika tidak ada perubahan
+_user_info_cache = {}
+_user_info_lock = threading.Lock()
+
+
+@firestore.transactional
+def _update_user_info_in_transaction(transaction, user_doc_ref, username: str, photo_url: str) -> bool:
+    snapshot = user_doc_ref.get(transaction=transaction)
+    user_data = snapshot.to_dict() or {}
+    if user_data.get('username') == username and user_data.get('photo') == photo_url:
+        return False
+
+    # SERVER_TIMESTAMP tidak bisa dipakai di dalam array, gunakan waktu lokal (UTC)
+    history = user_data.get('history', [])
+    history.append({
         'username': username,
         'photo': photo_url,
-        'timestamp': firestore.SERVER_TIMESTAMP
+        'timestamp': datetime.now(pytz.utc)
     })
+    transaction.update(user_doc_ref, {
+        'username': username,
+        'photo': photo_url,
+        'history': history[-USER_HISTORY_LIMIT:]
+    })
+    return True
+
 
-    # Batched write untuk menghapus entri lama jika melebihi batas
-    batch = db.batch()
-    entries = history_ref.order_by('timestamp').limit_to_last(6).get()
-    if len(entries) > 5:
-        for entry in entries[:-5]:
-            batch.delete(entry.reference)
-    batch.commit()
+def forget_user_info(user_id):
+    with _user_info_lock:
+        _user_info_cache.pop(str(user_id), None)
 
 
-def calculate_hash(file_path: str) -> str:
+def update_user_info(user_id: str, username: str, photo_url: str):
+    with _user_info_lock:
+        if _user_info_cache.get(str(user_id)) == (username, photo_url):
+            return  # Tidak ada perubahan, tidak perlu menulis
+
+    # Referensi ke dokumen pengguna di koleksi utama
+    user_doc_ref = get_db().collection('users').document(str(user_id))
+    with observe_backend('firestore', 'transaction.update_user_info'):
+        _update_user_info_in_transaction(get_db().transaction(), user_doc_ref, username, photo_url)
+
+    with _user_info_lock:
+        _user_info_cache[str(user_id)] = (username, photo_url)
+
+
+def migrate_user_history():
+    """Fold the legacy users/{id}/history subcollections into the history array."""
+    migrated = 0
+    for user_doc in get_db().collection('users').stream():
+        history_ref = user_doc.reference.collection('history')
+        entries = history_ref.order_by('timestamp').get()
+        if not entries:
+            continue
+
+        legacy_history = [
+            {
+                'username': entry.get('username'),
+                'photo': entry.get('photo'),
+                'timestamp': entry.get('timestamp')
+            }
+            for entry in entries
+        ]
+        history = sorted(legacy_history + user_doc.to_dict().get('history', []),
+                         key=lambda item: item['timestamp'] or datetime.min.replace(tzinfo=pytz.utc))
+        user_doc.reference.update({'history': history[-USER_HISTORY_LIMIT:]})
+
+        # Hapus subkoleksi lama (batas 500 operasi per batch)
+        for index in range(0, len(entries), 500):
+            batch = get_db().batch()
+            for entry in entries[index:index + 500]:
+                batch.delete(entry.reference)
+            batch.commit()
+        migrated += 1
+    logging.info(f'Migrated history of {migrated} users.')
+
+
+def calculate_hash(file_obj) -> str:
     hasher = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        while chunk := f.read(8192):
-            hasher.update(chunk)
+    file_obj.seek(0)
+    while chunk := file_obj.read(8192):
+        hasher.update(chunk)
     return hasher.hexdigest()
 
 
+def upload_profile_photo(photo_buffer):
+    """Store a profile photo content-addressed by its SHA-256; returns (url, hash)."""
+    file_hash = calculate_hash(photo_buffer)
+    blob = get_bucket().blob(f'profile_photos/{file_hash}.jpg')
+    with observe_backend('storage', 'blob.exists'):
+        exists = blob.exists()
+    if not exists:
+        photo_buffer.seek(0)
+        with observe_backend('storage', 'blob.upload'):
+            blob.upload_from_file(photo_buffer, content_type='image/jpeg')
+    return blob.public_url, file_hash
+
+
+# Cache metadata foto profil terakhir per pengguna (isi field last_photo)
+_last_photo_cache = {}
+_last_photo_lock = threading.Lock()
+
 
 def get_last_photo_metadata(user_id: str) -> dict:
-    user_ref = db.collection('users').document(str(user_id))
-    user_doc = user_ref.get()
-    if user_doc.exists:
-        return user_doc.to_dict().get('last_photo', {})
-    return {}
-
-def update_last_photo_metadata(user_id: str, file_id: str, photo_url: str, file_hash: str):
-    user_ref = db.collection('users').document(str(user_id))
-    user_ref.update({
-        'last_photo': {
-            'file_id': file_id,
-            'url': photo_url,
-            'hash': file_hash
-        }
-    })
+    with _last_photo_lock:
+        if str(user_id) in _last_photo_cache:
+            return _last_photo_cache[str(user_id)]
+    user_ref = get_db().collection('users').document(str(user_id))
+    with observe_backend('firestore', 'users.get'):
+        user_doc = user_ref.get()
+    last_photo = user_doc.to_dict().get('last_photo', {}) if user_doc.exists else {}
+    with _last_photo_lock:
+        _last_photo_cache[str(user_id)] = last_photo
+    return last_photo
+
+def update_last_photo_metadata(user_id: str, file_id: str, file_unique_id: str, photo_url: str, file_hash: str, **fields):
+    last_photo = {
+        'file_id': file_id,
+        'file_unique_id': file_unique_id,
+        'url': photo_url,
+        'hash': file_hash
+    }
+    user_ref = get_db().collection('users').document(str(user_id))
+    with observe_backend('firestore', 'users.update'):
+        user_ref.update(dict(fields, last_photo=last_photo))
+    with _last_photo_lock:
+        _last_photo_cache[str(user_id)] = last_photo
+
+
+def forget_last_photo_metadata(user_id: str):
+    with _last_photo_lock:
+        _last_photo_cache.pop(str(user_id), None)
 
 
 def handle_photo_update(user_id: str, context: CallbackContext):
-    temp_file_name = f'{user_id}_temp.jpg'
     try:
-        profile_photos = context.bot.get_user_profile_photos(user_id)
+        profile_photos = context.bot.get_user_profile_photos(user_id, limit=1)
         if profile_photos.total_count > 0:
             new_photo = profile_photos.photos[0][-1]
             new_file_id = new_photo.file_id
-            new_file = context.bot.get_file(new_file_id)
-            
+
             # Ambil metadata foto terakhir
             last_photo_metadata = get_last_photo_metadata(user_id)
-            last_file_hash = last_photo_metadata.get('hash', None)
 
-            # Unduh foto baru untuk dihitung hash-nya
-            new_file.download(temp_file_name)
-            new_file_hash = calculate_hash(temp_file_name)
-            
+            # Jalur cepat: file_unique_id sama berarti foto tidak berubah
+            if new_photo.file_unique_id and new_photo.file_unique_id == last_photo_metadata.get('file_unique_id'):
+                print("Foto tidak berubah. Tidak ada pembaruan.")
+                return last_photo_metadata.get('url', None)
+
+            # Unduh foto baru ke memori untuk dihitung hash-nya
+            photo_buffer = io.BytesIO()
+            download_telegram_file(context.bot, new_file_id, out=photo_buffer)
+            new_file_hash = calculate_hash(photo_buffer)
+
             # Periksa apakah foto baru berbeda dari foto terakhir
-            if new_file_hash == last_file_hash:
+            if new_file_hash == last_photo_metadata.get('hash', None):
                 print("Foto tidak berubah. Tidak ada pembaruan.")
+                # Simpan file_unique_id agar pengecekan berikutnya lewat jalur cepat
+                update_last_photo_metadata(user_id, new_file_id, new_photo.file_unique_id,
+                                           last_photo_metadata.get('url', None), new_file_hash)
                 return last_photo_metadata.get('url', None)
 
-            # Foto berbeda, unggah foto baru
-            increment = last_photo_metadata.get("timestamp", 0) + 1
-            file_name = f'{user_id}_{increment}.jpg'
-            blob = bucket.blob(f'profile_photos/{file_name}')
-            blob.upload_from_filename(temp_file_name)
-            profile_photo_url = blob.public_url
+            # Foto berbeda, unggah foto baru (nama file = hash, tidak pernah duplikat)
+            profile_photo_url, _ = upload_profile_photo(photo_buffer)
+
+            # Update metadata foto terakhir
+            update_last_photo_metadata(user_id, new_file_id, new_photo.file_unique_id, profile_photo_url, new_file_hash)
+
+            return profile_photo_url
+        return None
+    except Exception as e:
+        print(f"Error in handle_photo_update: {e}")
+        raise
+
+
+# Antrian pencarian pasangan: FIFO di memori, klaim pasangan secara atomik
+# lewat transaksi Firestore sehingga dua /search bersamaan tidak bisa
+# mendapatkan partner yang sama.
+_waiting_queue = deque()
+_waiting_set = set()
+_waiting_lock = threading.Lock()
+# Kandidat yang sedang diklaim tidak terlihat di antrian dan bisa kembali
+# jika klaim gagal; antrian baru dianggap kosong jika tidak ada klaim berjalan
+_waiting_cond = threading.Condition(_waiting_lock)
+_claims_in_flight = 0
+
+
+def load_waiting_queue():
+    """Load the waiting users into the in-memory queue once at startup."""
+    waiting_ids = state_backend.load_waiting()
+    with _waiting_lock:
+        for waiting_id in waiting_ids:
+            if waiting_id not in _waiting_set:
+                _waiting_set.add(waiting_id)
+                _waiting_queue.append(waiting_id)
+    logging.info(f'Loaded {len(_waiting_set)} waiting users into the matchmaking queue.')
+
+
+def is_waiting(user_id) -> bool:
+    with _waiting_lock:
+        return str(user_id) in _waiting_set
+
+
+def enqueue_waiting(user_id):
+    key = str(user_id)
+    state_backend.add_waiting(key)
+    with _waiting_lock:
+        if key not in _waiting_set:
+            _waiting_set.add(key)
+            _waiting_queue.append(key)
+
+
+def _pop_waiting_candidate(user_id: str):
+    global _claims_in_flight
+    with _waiting_cond:
+        while True:
+            skipped_self = False
+            candidate = None
+            while _waiting_queue:
+                head = _waiting_queue.popleft()
+                if head not in _waiting_set:
+                    continue  # Entri basi, pengguna sudah keluar dari antrian
+                if head == user_id:
+                    skipped_self = True
+                    continue
+                candidate = head
+                _waiting_set.discard(head)
+                break
+            if skipped_self:
+                _waiting_queue.appendleft(user_id)
+            if candidate is not None:
+                _claims_in_flight += 1
+                return candidate
+            if _claims_in_flight == 0:
+                return None
+            _waiting_cond.wait()
+
+
+def _finish_claim(requeue_id=None):
+    # Klaim selesai; kandidat yang gagal diklaim dikembalikan ke depan antrian
+    global _claims_in_flight
+    with _waiting_cond:
+        if requeue_id is not None and requeue_id not in _waiting_set:
+            _waiting_set.add(requeue_id)
+            _waiting_queue.appendleft(requeue_id)
+        _claims_in_flight -= 1
+        _waiting_cond.notify_all()
+
+
+def claim_waiting_partner(user_id):
+    """Pop the oldest waiting user and pair them with user_id atomically. Returns partner_id or None."""
+    key = str(user_id)
+    while True:
+        partner_id = _pop_waiting_candidate(key)
+        if partner_id is None:
+            return None
+        requeue = False
+        try:
+            # Dengan beberapa worker, kandidat di-lease dulu; kandidat yang sedang
+            # dipegang worker lain atau sudah dipasangkan dilewati
+            if WORKER_COUNT > 1 and not state_backend.lease_waiting(partner_id, WORKER_ID):
+                continue
+            if state_backend.claim_pair(key, partner_id, WORKER_ID):
+                forget_session_events(key, partner_id)
+                forget_waiting(key)
+                cache_partner(key, partner_id)
+                cache_partner(partner_id, key)
+                return partner_id
+            current_partner = state_backend.get_partner(key)
+            if current_partner is not None:
+                # Pengguna ini baru saja dipasangkan oleh pencarian lain; kandidat tetap
+                # menunggu, kecuali kandidat itu sendiri yang menjadi pasangannya
+                requeue = current_partner != partner_id
+                if not requeue:
+                    forget_waiting(partner_id)
+                forget_waiting(key)
+                cache_partner(key, current_partner)
+                return None
+        except Exception:
+            requeue = True
+            raise
+        finally:
+            _finish_claim(partner_id if requeue else None)
+
+
+def forget_waiting(user_id):
+    with _waiting_lock:
+        _waiting_set.discard(str(user_id))
+
+
+_session_unsubscribe = None
+
+
+def on_session_change(kind, user_id, value):
+    # Perubahan sesi dari worker lain: perbarui cache pasangan dan antrian lokal
+    if kind == 'active':
+        cache_partner(user_id, value)
+    elif value:
+        with _waiting_lock:
+            if user_id not in _waiting_set:
+                _waiting_set.add(user_id)
+                _waiting_queue.append(user_id)
+    else:
+        forget_waiting(user_id)
+
+
+def start_session_watch():
+    """With several workers, keep the partner cache and waiting queue in step with the shared store."""
+    global _session_unsubscribe
+    if WORKER_COUNT > 1:
+        _session_unsubscribe = state_backend.watch_sessions(on_session_change)
+
+
+def stop_session_watch():
+    if _session_unsubscribe is not None:
+        _session_unsubscribe()
+
+
+# Ring buffer per sesi: N event terakhir yang diteruskan (teks, file_id
+# stiker/foto/voice, lokasi) disimpan di memori agar laporan ke admin bisa
+# langsung menyertakan potongan percakapan tanpa membaca Drive atau Firestore.
+SESSION_EVENT_LIMIT = int(os.getenv('SESSION_EVENT_LIMIT', '50'))
+SESSION_EVENT_SESSIONS = int(os.getenv('SESSION_EVENT_SESSIONS', '10000'))
+SESSION_EVENT_TEXT_LIMIT = 300
+
+_session_events = OrderedDict()
+_session_events_lock = threading.Lock()
+
+
+def _session_key(user_id, partner_id):
+    return tuple(sorted((str(user_id), str(partner_id))))
+
+
+def record_session_event(user_id, partner_id, kind, content):
+    """Remember a relayed event in the bounded buffer of the user's current session."""
+    if len(content) > SESSION_EVENT_TEXT_LIMIT:
+        content = content[:SESSION_EVENT_TEXT_LIMIT] + '…'
+    key = _session_key(user_id, partner_id)
+    event = (datetime.now().strftime('%H:%M:%S'), str(user_id), kind, content)
+    with _session_events_lock:
+        events = _session_events.get(key)
+        if events is None:
+            events = _session_events[key] = deque(maxlen=SESSION_EVENT_LIMIT)
+            while len(_session_events) > SESSION_EVENT_SESSIONS:
+                _session_events.popitem(last=False)
+        else:
+            _session_events.move_to_end(key)
+        events.append(event)
+
+
+def get_session_events(user_id, partner_id):
+    with _session_events_lock:
+        return list(_session_events.get(_session_key(user_id, partner_id), ()))
+
+
+def forget_session_events(user_id, partner_id):
+    with _session_events_lock:
+        _session_events.pop(_session_key(user_id, partner_id), None)
+
 
-            # Update metadata foto terakhir
-            update_last_photo_metadata(user_id, new_file_id, profile_photo_url, new_file_hash)
+def format_session_events(events):
+    return '\n'.join(f"{when} {sender} {kind}: {content}" for when, sender, kind, content in events)
 
-            return profile_photo_url
+
+# Session store: setiap operasi sesi (putuskan, ban) ditulis sekaligus oleh
+# state backend, sehingga tidak ada lagi pengguna yang setengah terpasang jika
+# proses mati di tengah jalan. Pasangan dibuat oleh claim_waiting_partner.
+def unpair_session(user_id):
+    """End the user's chat; returns the former partner_id or None."""
+    partner_id = get_partner(user_id)
+    if partner_id is None:
         return None
-    except Exception as e:
-        print(f"Error in handle_photo_update: {e}")
-        raise
-    finally:
-        if os.path.exists(temp_file_name):
-            os.remove(temp_file_name)  # Hapus file sementara setelah diunggah atau jika terjadi kesalahan
+
+    state_backend.unpair(str(user_id), str(partner_id))
+    forget_session_events(user_id, partner_id)
+    cache_partner(user_id, None)
+    cache_partner(partner_id, None)
+    return partner_id
 
 
+def ban_session(target_id, user_data: dict):
+    """Ban the user and end any chat or wait in one write; returns the former partner_id."""
+    target_id = str(target_id)
+    partner_id = get_partner(target_id)
+
+    state_backend.ban(target_id, user_data, str(partner_id) if partner_id is not None else None)
+
+    mark_banned(target_id)
+    forget_waiting(target_id)
+    cache_partner(target_id, None)
+    if partner_id is not None:
+        cache_partner(partner_id, None)
+        forget_session_events(target_id, partner_id)
+    return partner_id
+
+
+def unban_session(target_id, user_data: dict):
+    target_id = str(target_id)
+    state_backend.unban(target_id, user_data)
+    mark_banned(target_id, banned=False)
+
 
 # Fungsi Mencari User
 def search(update: Update, context: CallbackContext):
@@ -295,8 +1888,9 @@ def search(update: Update, context: CallbackContext):
         return
 
     # Periksa apakah pengguna terdaftar
-    user_ref = db.collection('users').document(str(user_id))
-    user_doc = user_ref.get()
+    user_ref = get_db().collection('users').document(str(user_id))
+    with observe_backend('firestore', 'users.get'):
+        user_doc = user_ref.get()
 
     if not user_doc.exists:
         context.bot.send_message(
@@ -307,10 +1901,7 @@ def search(update: Update, context: CallbackContext):
         return
 
     # Periksa apakah pengguna sudah terhubung dengan pasangan
-    active_chat_ref = db.collection('active_chats').document(str(user_id))
-    active_chat_doc = active_chat_ref.get()
-
-    if active_chat_doc.exists:
+    if get_partner(user_id) is not None:
         context.bot.send_message(
             chat_id=user_id,
             text=
@@ -319,45 +1910,37 @@ def search(update: Update, context: CallbackContext):
         return
 
     # Perbarui informasi pengguna di daftar tunggu jika ada
-    waiting_ref = db.collection('waiting_users')
-    waiting_users = waiting_ref.get()
-
-    for waiting_user in waiting_users:
-        if waiting_user.id == str(user_id):
-            profile_photo_url = handle_photo_update(user_id, context)
-            username = update.message.from_user.username or "Tidak ada username"
-            if profile_photo_url:
-                update_user_info(user_id, username, profile_photo_url)
-            break
-
-    # Periksa ulang daftar pengguna yang menunggu
-    waiting_users = waiting_ref.get()
-    if waiting_users:
-        partner_id = waiting_users[0].id
-
-        if partner_id == str(user_id):
-            # Jangan pertemukan pengguna dengan dirinya sendiri
-            context.bot.send_message(
-                chat_id=user_id,
-                text="Silakan Tunggu, Sedang Menemukan Pasangan....")
+    if is_waiting(user_id):
+        profile_photo_url = handle_photo_update(user_id, context)
+        username = update.message.from_user.username or "Tidak ada username"
+        if profile_photo_url:
+            update_user_info(user_id, username, profile_photo_url)
+
+    # Ambil pengguna terlama dari antrian dan pasangkan secara atomik
+    partner_id = claim_waiting_partner(user_id)
+    if partner_id is None and not is_waiting(user_id) and get_partner(user_id) is None:
+        # Masuk daftar tunggu lalu coba sekali lagi: pengguna lain yang pada saat
+        # yang sama juga menemukan antrian kosong sekarang sudah terlihat di antrian,
+        # sehingga dua pencarian bersamaan tidak sama-sama menunggu
+        enqueue_waiting(user_id)
+        partner_id = claim_waiting_partner(user_id)
+        if partner_id is None:
+            # Jika sudah dipasangkan oleh pencarian lain, pesan dikirim oleh pencarian itu
+            if get_partner(user_id) is None:
+                context.bot.send_message(chat_id=user_id,
+                                         text="Menunggu pasangan. Mohon tunggu...")
             return
 
-        # Hapus pengguna dari daftar tunggu dan simpan pasangan
-        db.collection('waiting_users').document(partner_id).delete()
-        db.collection('active_chats').document(str(user_id)).set(
-            {'partner': partner_id})
-        db.collection('active_chats').document(str(partner_id)).set(
-            {'partner': user_id})
-
+    if partner_id is not None:
         context.bot.send_message(
             chat_id=user_id, text="Pasangan ditemukan! Mulailah mengobrol.")
         context.bot.send_message(
             chat_id=partner_id, text="Pasangan ditemukan! Mulailah mengobrol.")
-    else:
-        # Tambahkan pengguna ke daftar tunggu
-        db.collection('waiting_users').document(str(user_id)).set({})
-        context.bot.send_message(chat_id=user_id,
-                                 text="Menunggu pasangan. Mohon tunggu...")
+    elif is_waiting(user_id):
+        # Jangan pertemukan pengguna dengan dirinya sendiri
+        context.bot.send_message(
+            chat_id=user_id,
+            text="Silakan Tunggu, Sedang Menemukan Pasangan....")
 
 
 # Fungsi untuk menghentikan chat
@@ -371,14 +1954,9 @@ def stop_chat(update: Update, context: CallbackContext):
                                  text="Terjadi kesalahan.")
         return
 
-    chat_ref = db.collection('active_chats').document(str(user_id))
-    chat = chat_ref.get()
-
-    if chat.exists:
-        partner_id = chat.to_dict()['partner']
-        db.collection('active_chats').document(str(user_id)).delete()
-        db.collection('active_chats').document(str(partner_id)).delete()
+    partner_id = unpair_session(user_id)
 
+    if partner_id is not None:
         context.bot.send_message(
             chat_id=user_id,
             text=
@@ -404,17 +1982,12 @@ def next_chat(update: Update, context: CallbackContext):
 
 
     # Perbarui informasi pengguna di daftar tunggu jika ada
-    waiting_ref = db.collection('waiting_users')
-    waiting_users = waiting_ref.get()
-
-    for waiting_user in waiting_users:
-        if waiting_user.id == str(user_id):
-            # Ambil foto profil terbaru dan username
-            profile_photo_url = handle_photo_update(user_id, context)
-            username = update.message.from_user.username or "Tidak ada username"
-            if profile_photo_url:
-                update_user_info(user_id, username, profile_photo_url)
-            break
+    if is_waiting(user_id):
+        # Ambil foto profil terbaru dan username
+        profile_photo_url = handle_photo_update(user_id, context)
+        username = update.message.from_user.username or "Tidak ada username"
+        if profile_photo_url:
+            update_user_info(user_id, username, profile_photo_url)
 
   
     # Hentikan chat saat ini
@@ -428,75 +2001,374 @@ def generate_unique_timestamp():
     return datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
 
 
-# Pengelola Pesan
-MAX_LOG_SIZE_MB = 10
-MAX_LOG_SIZE_BYTES = MAX_LOG_SIZE_MB * 1024 * 1024
+# Penulis event pesan: event dari handler relay (teks, foto, stiker, voice,
+# lokasi) dikumpulkan di memori lalu ditulis ke koleksi messages per batch,
+# saat batch penuh atau setiap MESSAGE_FLUSH_INTERVAL detik. ID dokumen
+# diawali timestamp (tetap terurut waktu) plus sufiks acak agar tidak bentrok.
+MESSAGE_BATCH_SIZE = min(int(os.getenv('MESSAGE_BATCH_SIZE', '500')), 500)  # Batas batch Firestore
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', '2'))
+MESSAGE_BUFFER_LIMIT = int(os.getenv('MESSAGE_BUFFER_LIMIT', '10000'))
+MESSAGE_WRITE_ATTEMPTS = 3
+# Isi pesan teks hanya disimpan jika diaktifkan; defaultnya hanya panjangnya
+MESSAGE_STORE_TEXT = os.getenv('MESSAGE_STORE_TEXT', 'false').lower() == 'true'
+
+_message_buffer = deque()
+_message_cond = threading.Condition()
+_message_flush_lock = threading.Lock()
+_message_writer_thread = None
+_message_writer_stopping = False
+message_writer_stats = {'queued': 0, 'written': 0, 'batches': 0, 'failed': 0, 'dropped': 0}
+
+
+def record_message_event(sender_id, recipient_id, kind, content, **fields):
+    """Buffer one event for the messages collection; it is written with the next batch."""
+    timestamp = generate_unique_timestamp()
+    event = dict(fields, sender_id=sender_id, recipient_id=recipient_id, type=kind,
+                 content=content, timestamp=timestamp)
+    with _message_cond:
+        if len(_message_buffer) >= MESSAGE_BUFFER_LIMIT:
+            message_writer_stats['dropped'] += 1
+            return
+        _message_buffer.append((f'{timestamp}_{uuid.uuid4().hex[:12]}', event))
+        message_writer_stats['queued'] += 1
+        if len(_message_buffer) >= MESSAGE_BATCH_SIZE:
+            _message_cond.notify()
+
+
+def _write_message_batch(events):
+    for attempt in range(1, MESSAGE_WRITE_ATTEMPTS + 1):
+        try:
+            collection = get_db().collection('messages')
+            batch = get_db().batch()
+            for doc_id, event in events:
+                batch.set(collection.document(doc_id), event)
+            with observe_backend('firestore', 'messages.batch_commit'):
+                batch.commit()
+            message_writer_stats['written'] += len(events)
+            message_writer_stats['batches'] += 1
+            return
+        except Exception as e:
+            logging.warning(f'Message batch of {len(events)} failed (attempt {attempt}): {e}')
+            if attempt < MESSAGE_WRITE_ATTEMPTS:
+                time.sleep(attempt)
+    logging.error(f'Dropping {len(events)} message events after {MESSAGE_WRITE_ATTEMPTS} attempts.')
+    message_writer_stats['failed'] += len(events)
+
+
+def flush_message_events():
+    """Write every buffered event now, in batches of MESSAGE_BATCH_SIZE."""
+    with _message_flush_lock:
+        while True:
+            with _message_cond:
+                events = [_message_buffer.popleft() for _ in range(min(len(_message_buffer), MESSAGE_BATCH_SIZE))]
+            if not events:
+                return
+            _write_message_batch(events)
 
-def get_log_file_path(user_id):
-    """Return the current log file path based on size and version."""
-    base_path = '/tmp'
-    log_file_prefix = f'{user_id}_chat_log'
-    log_file_suffix = 1
 
+def _message_writer_loop():
     while True:
-        log_file_path = os.path.join(base_path, f'{log_file_prefix}_{log_file_suffix}.txt')
-        if not os.path.exists(log_file_path) or os.path.getsize(log_file_path) < MAX_LOG_SIZE_BYTES:
-            return log_file_path
-        log_file_suffix += 1
+        with _message_cond:
+            deadline = time.monotonic() + MESSAGE_FLUSH_INTERVAL
+            while len(_message_buffer) < MESSAGE_BATCH_SIZE and not _message_writer_stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _message_cond.wait(remaining)
+            stopping = _message_writer_stopping
+        flush_message_events()
+        if stopping:
+            return
 
-def handle_message(update: Update, context: CallbackContext):
-    user_id = update.message.from_user.id
-    chat_ref = db.collection('active_chats').document(str(user_id))
-    chat = chat_ref.get()
 
-    if chat.exists:
-        partner_id = chat.to_dict().get('partner')
-        timestamp = datetime.now().isoformat()
+def start_message_writer():
+    global _message_writer_thread, _message_writer_stopping
+    _message_writer_stopping = False
+    _message_writer_thread = threading.Thread(target=_message_writer_loop, name='message-writer', daemon=True)
+    _message_writer_thread.start()
+
+
+def stop_message_writer():
+    """Stop the writer after the buffered events have been committed."""
+    global _message_writer_stopping
+    with _message_cond:
+        _message_writer_stopping = True
+        _message_cond.notify()
+    if _message_writer_thread is not None:
+        _message_writer_thread.join()
+    flush_message_events()
+    logging.info(f"Message writer stopped: {message_writer_stats['written']} written in "
+                 f"{message_writer_stats['batches']} batches, {message_writer_stats['failed']} failed, "
+                 f"{message_writer_stats['dropped']} dropped")
+
+
+# Pengelola Pesan
+# Log chat per pengguna disimpan sebagai segmen gzip. Setiap blok adalah satu
+# member gzip tersendiri (file tetap bisa dibaca dengan zcat) dan dicatat di
+# file indeks .idx bersama partner dan rentang waktunya, sehingga percakapan
+# satu pasangan bisa dibaca tanpa membuka seluruh log. Segmen yang masih
+# ditulis bernama *.open.gz; saat ditutup namanya menjadi *.log.gz dan
+# segmen itu diunggah ke Drive satu kali.
+MAX_LOG_SIZE_MB = 10
+MAX_LOG_SIZE_BYTES = MAX_LOG_SIZE_MB * 1024 * 1024  # Ukuran segmen setelah dikompres
+
+LOG_DIR = '/tmp'
+LOG_BLOCK_BYTES = int(os.getenv('LOG_BLOCK_BYTES', str(64 * 1024)))  # Ukuran blok sebelum dikompres
+LOG_BLOCK_MAX_AGE = float(os.getenv('LOG_BLOCK_MAX_AGE', '60'))
+LOG_SEGMENT_MAX_AGE = float(os.getenv('LOG_SEGMENT_MAX_AGE', '3600'))
+LOG_COMPRESS_LEVEL = int(os.getenv('LOG_COMPRESS_LEVEL', '6'))
+# Nomor segmen dibangun ulang dari LOG_DIR, yang kosong lagi setelah dyno
+# restart; id boot ini membuat nama segmen yang diunggah ke Drive tetap unik
+LOG_BOOT_ID = f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:6]}"
+_LOG_FILE_PATTERN = re.compile(r'^(.+)_chat_log_(\d+)\.(open|log)\.gz$')
+
+# State log per pengguna: segmen terbuka, ukurannya, dan baris yang belum dikompres
+_log_segments = {}
+_log_lock = threading.Lock()
+
+
+def _log_segment_path(user_key, segment, sealed=False):
+    return os.path.join(LOG_DIR, f"{user_key}_chat_log_{segment}.{'log' if sealed else 'open'}.gz")
+
+
+def _log_index_path(segment_path):
+    return segment_path[:-len('.gz')] + '.idx'
+
+
+def _new_log_state(segment, size=0):
+    now = time.monotonic()
+    return {'segment': segment, 'size': size, 'opened': now, 'touched': now,
+            'lines': [], 'pending': 0, 'partner': None, 'first': None, 'last': None, 'since': None}
+
+
+def load_log_segments():
+    """Rebuild the open segment of every user of this worker from a single directory scan."""
+    with _log_lock:
+        with os.scandir(LOG_DIR) as entries:
+            for entry in entries:
+                match = _LOG_FILE_PATTERN.match(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                user_key, segment = match.group(1), int(match.group(2))
+                if worker_for_user(user_key) != WORKER_INDEX:
+                    continue  # LOG_DIR dipakai bersama; segmen ini milik worker lain
+                if match.group(3) == 'log':
+                    segment, size = segment + 1, 0  # Segmen ini sudah ditutup
+                else:
+                    size = entry.stat().st_size
+                current = _log_segments.get(user_key)
+                if current is None or segment > current['segment']:
+                    _log_segments[user_key] = _new_log_state(segment, size)
+    logging.info(f'Loaded log segments for {len(_log_segments)} users.')
+
+
+def _current_log_state(user_key):
+    # Dipanggil dengan _log_lock dipegang
+    state = _log_segments.get(user_key)
+    if state is None:
+        # Pengguna belum dikenal: lewati segmen yang sudah ditutup
+        segment = 1
+        while os.path.exists(_log_segment_path(user_key, segment, sealed=True)):
+            segment += 1
+        path = _log_segment_path(user_key, segment)
+        state = _log_segments[user_key] = _new_log_state(segment, os.path.getsize(path) if os.path.exists(path) else 0)
+    return state
+
+
+def _flush_log_block(user_key, state):
+    # Dipanggil dengan _log_lock: kompres baris yang tertahan menjadi satu blok
+    if not state['lines']:
+        return
+    block = gzip.compress(b''.join(state['lines']), compresslevel=LOG_COMPRESS_LEVEL)
+    path = _log_segment_path(user_key, state['segment'])
+    with open(path, 'ab') as segment_file:
+        offset = segment_file.tell()
+        segment_file.write(block)
+    entry = {'offset': offset, 'length': len(block), 'partner': state['partner'],
+             'first': state['first'], 'last': state['last'], 'lines': len(state['lines'])}
+    with open(_log_index_path(path), 'a') as index_file:
+        index_file.write(json.dumps(entry) + '\n')
+    state.update(size=offset + len(block), lines=[], pending=0, partner=None, first=None, last=None, since=None)
+
+
+def _seal_log_segment(user_key, state):
+    # Dipanggil dengan _log_lock: tutup segmen dan unggah sekali lewat pipeline arsip
+    _flush_log_block(user_key, state)
+    if state['size'] == 0:
+        return False
+    open_path = _log_segment_path(user_key, state['segment'])
+    sealed_path = _log_segment_path(user_key, state['segment'], sealed=True)
+    os.replace(_log_index_path(open_path), _log_index_path(sealed_path))
+    os.replace(open_path, sealed_path)
+    for path in (sealed_path, _log_index_path(sealed_path)):
+        submit_archive_job('drive_segment', file_path=path, folder_id=CHAT_LOG_FOLDER_ID,
+                           file_name=_sealed_drive_name(path))
+    log_upload_stats['submitted'] += 1
+    _log_segments[user_key] = _new_log_state(state['segment'] + 1)
+    return True
+
+
+def _sealed_drive_name(path):
+    # {user}_chat_log_{N}.log.gz -> {user}_chat_log_{N}_{LOG_BOOT_ID}.log.gz (juga .log.idx)
+    stem, _, suffix = os.path.basename(path).partition('.log.')
+    return f'{stem}_{LOG_BOOT_ID}.log.{suffix}'
+
+
+def append_chat_log(user_id, partner_id, timestamp, message_data):
+    """Buffer a log line of the user's chat with partner_id; lines are compressed block by block."""
+    data = message_data.encode('utf-8')
+    user_key, partner_key = str(user_id), str(partner_id)
+    with _log_lock:
+        state = _current_log_state(user_key)
+        if state['lines'] and state['partner'] != partner_key:
+            _flush_log_block(user_key, state)  # Satu blok hanya berisi satu pasangan
+        if not state['lines']:
+            state.update(partner=partner_key, first=timestamp, since=time.monotonic())
+        state['lines'].append(data)
+        state['pending'] += len(data)
+        state['last'] = timestamp
+        state['touched'] = time.monotonic()
+        if state['pending'] >= LOG_BLOCK_BYTES:
+            _flush_log_block(user_key, state)
+            if state['size'] >= MAX_LOG_SIZE_BYTES:
+                _seal_log_segment(user_key, state)
+
+
+def maintain_log_segments():
+    """Compress blocks buffered longer than LOG_BLOCK_MAX_AGE and seal segments older than LOG_SEGMENT_MAX_AGE."""
+    now = time.monotonic()
+    with _log_lock:
+        for user_key, state in list(_log_segments.items()):
+            try:
+                if state['lines'] and now - state['since'] >= LOG_BLOCK_MAX_AGE:
+                    _flush_log_block(user_key, state)
+                if state['size'] and now - state['opened'] >= LOG_SEGMENT_MAX_AGE:
+                    _seal_log_segment(user_key, state)
+                # Pengguna yang masih aktif tetap di memori dan langsung menulis ke
+                # segmen baru; hanya pengguna yang lama tidak aktif yang dilepas
+                current = _log_segments[user_key]
+                if not current['size'] and not current['lines'] and now - state['touched'] >= LOG_SEGMENT_MAX_AGE:
+                    del _log_segments[user_key]
+            except OSError as e:
+                logging.error(f"Failed to maintain log segment {state['segment']} of {user_key}: {e}")
+                _log_segments.pop(user_key, None)  # Dibangun ulang dari disk saat baris berikutnya
+
+
+def seal_all_log_segments():
+    """Seal (and queue the upload of) every open segment; returns how many were sealed."""
+    sealed = 0
+    with _log_lock:
+        for user_key, state in list(_log_segments.items()):
+            try:
+                sealed += _seal_log_segment(user_key, state)
+            except OSError as e:
+                logging.error(f"Failed to seal log segment {state['segment']} of {user_key}: {e}")
+                _log_segments.pop(user_key, None)  # Dibangun ulang dari disk saat baris berikutnya
+    return sealed
+
+
+def get_log_upload_backlog():
+    with _log_lock:
+        now = time.monotonic()
+        open_states = [state for state in _log_segments.values() if state['size'] or state['lines']]
+        return {
+            'files': len(open_states),
+            'bytes': sum(state['size'] + state['pending'] for state in open_states),
+            'oldest_age': max((now - state['opened'] for state in open_states), default=0.0),
+        }
+
 
-        log_file_path = get_log_file_path(user_id)
+def _log_line_time(line):
+    return line.split(' - ', 1)[0]
 
+
+def _read_log_segment(user_key, segment, partner_key, since, until):
+    # Segmen bisa ditutup (diganti nama) saat sedang dibaca, jadi coba kedua nama
+    for sealed in (True, False, True):
+        path = _log_segment_path(user_key, segment, sealed=sealed)
         try:
-            # Periksa apakah pesan yang diterima adalah teks
-            if update.message.text:
-                message_data = f"{timestamp} - {user_id} to {partner_id}: {update.message.text}\n"
-                with open(log_file_path, 'a') as log_file:
-                    log_file.write(message_data)
-                
-                context.bot.send_message(chat_id=partner_id, text=update.message.text)
-                
-                # Upload file log setelah menulis pesan
-                upload_log_to_google_drive(log_file_path, '1OQpqIlKPYWSvOTaXqQIOmMW3g1N0sQzf')
+            with open(_log_index_path(path)) as index_file:
+                entries = [json.loads(line) for line in index_file if line.strip()]
+            lines = []
+            with open(path, 'rb') as segment_file:
+                for entry in entries:
+                    if partner_key is not None and entry['partner'] != partner_key:
+                        continue
+                    if (since and entry['last'] < since) or (until and entry['first'] > until):
+                        continue
+                    segment_file.seek(entry['offset'])
+                    block = gzip.decompress(segment_file.read(entry['length'])).decode('utf-8')
+                    lines.extend(line for line in block.splitlines(keepends=True)
+                                 if not (since and _log_line_time(line) < since)
+                                 and not (until and _log_line_time(line) > until))
+            return lines
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def read_transcript(user_id, partner_id=None, since=None, until=None):
+    """Return the lines logged by user_id, optionally only to partner_id and within [since, until] (ISO times)."""
+    user_key = str(user_id)
+    partner_key = str(partner_id) if partner_id is not None else None
+    with _log_lock:
+        state = _log_segments.get(user_key)
+        if state is not None:
+            _flush_log_block(user_key, state)  # Sertakan baris yang masih di buffer
+
+    lines = []
+    segment = 1
+    while True:
+        segment_lines = _read_log_segment(user_key, segment, partner_key, since, until)
+        if segment_lines is None:
+            return lines
+        lines.extend(segment_lines)
+        segment += 1
 
-            # Periksa apakah pesan yang diterima adalah stiker
-            elif update.message.sticker:
-                sticker = update.message.sticker
-                if sticker:  # Memeriksa apakah sticker tidak None
-                    sticker_id = sticker.file_id
-                    sticker_file_path = f'/tmp/{user_id}_sticker_{sticker_id}.png'
 
-                    context.bot.send_sticker(chat_id=partner_id, sticker=sticker_id)
+def read_conversation(user_id, partner_id, since=None, until=None):
+    """Return both sides of the chat between user_id and partner_id in time order."""
+    lines = read_transcript(user_id, partner_id, since, until) + read_transcript(partner_id, user_id, since, until)
+    return sorted(lines, key=_log_line_time)
 
-                    try:
-                        # Get file info and download sticker
-                        file_info = context.bot.get_file(sticker_id)
-                    
-                        # Download file directly
-                        file_info.download(sticker_file_path)
-                    
-                        # Upload sticker to Google Drive
-                        upload_log_to_google_drive(sticker_file_path, '1KbEpuvg0rKDJSD76oPDi_RFecEcPxFE6')
-
-                    except Exception as e:
-                        logging.error(f"An error occurred while handling sticker: {e}")
-                    finally:
-                        # Remove local file after upload
-                        if os.path.exists(sticker_file_path):
-                            os.remove(sticker_file_path)
-                            logging.info(f'Removed local file {sticker_file_path}')
 
-        except Exception as e:
-            logging.error(f"Error handling message: {e}")
-            context.bot.send_message(chat_id=user_id, text="Terjadi kesalahan saat memproses pesan.")
+def handle_message(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    partner_id = get_partner(user_id)
+
+    if partner_id is not None:
+        timestamp = datetime.now().isoformat()
+
+        # Periksa apakah pesan yang diterima adalah teks
+        if update.message.text:
+            message_data = f"{timestamp} - {user_id} to {partner_id}: {update.message.text}\n"
+            append_chat_log(user_id, partner_id, timestamp, message_data)
+                
+            context.bot.send_message(chat_id=partner_id, text=update.message.text)
+            record_session_event(user_id, partner_id, 'text', update.message.text)
+            record_message_event(user_id, partner_id, 'text',
+                                 update.message.text if MESSAGE_STORE_TEXT else None,
+                                 length=len(update.message.text))
+
+        # Periksa apakah pesan yang diterima adalah stiker
+        elif update.message.sticker:
+            sticker = update.message.sticker
+            if sticker:  # Memeriksa apakah sticker tidak None
+                sticker_id = sticker.file_id
+
+                context.bot.send_sticker(chat_id=partner_id, sticker=sticker_id)
+                record_session_event(user_id, partner_id, 'sticker', sticker_id)
+                record_message_event(user_id, partner_id, 'sticker', sticker_id,
+                                     file_unique_id=sticker.file_unique_id)
+
+                # Arsipkan stiker ke Google Drive di background, sekali per file_unique_id;
+                # stiker yang sudah dikenal hanya dicatat sebagai referensi
+                if claim_sticker(sticker.file_unique_id):
+                    submit_archive_job('drive_sticker', user_id=user_id, file_id=sticker_id,
+                                       file_unique_id=sticker.file_unique_id)
+                message_data = (f"{timestamp} - {user_id} to {partner_id}: "
+                                f"Sent sticker {sticker_archive_name(sticker.file_unique_id)}\n")
+                append_chat_log(user_id, partner_id, timestamp, message_data)
     else:
         context.bot.send_message(chat_id=user_id, text="Anda belum terhubung dengan pasangan.")
 
@@ -504,41 +2376,53 @@ def handle_message(update: Update, context: CallbackContext):
 
 def handle_photo(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    chat_ref = db.collection('active_chats').document(str(user_id))
-    chat = chat_ref.get()
+    partner_id = get_partner(user_id)
 
-    if chat.exists:
-        partner_id = chat.to_dict().get('partner')
+    if partner_id is not None:
         photo = update.message.photo[-1]  # Ambil foto dengan resolusi tertinggi
         file_id = photo.file_id
-        photo_file_path = f'/tmp/{user_id}_photo_{file_id}.jpg'
         timestamp = datetime.now().isoformat()
 
         try:
-            # Dapatkan info file dan download foto
-            file_info = context.bot.get_file(file_id)
-            file_info.download(photo_file_path)
-
-            # Kirim foto ke partner_id
-            context.bot.send_photo(chat_id=partner_id, photo=open(photo_file_path, 'rb'))
-
-            # Upload foto ke Google Drive
-            upload_log_to_google_drive(photo_file_path, '1l8sutMRG0bN7_p5OZHFP4vPAWEVynhZa')
+            # Kirim foto ke partner_id langsung dengan file_id (tanpa unduh ulang)
+            context.bot.send_photo(chat_id=partner_id, photo=file_id)
+            record_session_event(user_id, partner_id, 'photo', file_id)
+            record_message_event(user_id, partner_id, 'photo', file_id, file_unique_id=photo.file_unique_id)
 
             # Log pengiriman foto
-            log_file_path = get_log_file_path(user_id)
             message_data = f"{timestamp} - {user_id} to {partner_id}: Sent a photo.\n"
-            with open(log_file_path, 'a') as log_file:
-                log_file.write(message_data)
+            append_chat_log(user_id, partner_id, timestamp, message_data)
+
+            # Arsipkan foto ke Google Drive di background (dari memori)
+            submit_archive_job('drive_photo', user_id=user_id, file_id=file_id)
 
         except Exception as e:
             logging.error(f"An error occurred while handling photo: {e}")
 
-        finally:
-            # Hapus file lokal setelah diupload
-            if os.path.exists(photo_file_path):
-                os.remove(photo_file_path)
-                logging.info(f'Removed local file {photo_file_path}')
+
+# file_unique_id voice note yang sudah diantrikan untuk diarsipkan; setelah
+# restart, cek blob.exists di job arsip yang mencegah unggahan ganda
+VOICE_SEEN_LIMIT = int(os.getenv('VOICE_SEEN_LIMIT', '10000'))
+_archived_voice_ids = OrderedDict()
+_archived_voice_lock = threading.Lock()
+
+
+def mark_voice_archived(file_unique_id):
+    """Return True the first time a voice note is seen, False for repeats."""
+    with _archived_voice_lock:
+        if file_unique_id in _archived_voice_ids:
+            _archived_voice_ids.move_to_end(file_unique_id)
+            return False
+        _archived_voice_ids[file_unique_id] = True
+        while len(_archived_voice_ids) > VOICE_SEEN_LIMIT:
+            _archived_voice_ids.popitem(last=False)
+        return True
+
+
+def release_voice(file_unique_id):
+    # Arsip gagal permanen: voice note boleh dicoba lagi saat dikirim berikutnya
+    with _archived_voice_lock:
+        _archived_voice_ids.pop(file_unique_id, None)
 
 
 def handle_voice_note(update: Update, context: CallbackContext):
@@ -548,33 +2432,19 @@ def handle_voice_note(update: Update, context: CallbackContext):
     # Dapatkan file_id dari voice note
     file_id = voice.file_id
 
-    # Ambil partner_id dari Firestore
-    chat_ref = db.collection('active_chats').document(str(user_id))
-    chat = chat_ref.get()
-    if chat.exists:
-        partner_id = chat.to_dict().get('partner')
+    # Ambil partner_id dari cache (Firestore hanya jika cache miss)
+    partner_id = get_partner(user_id)
+    if partner_id is not None:
 
-        try:
-            # Kirimkan voice note ke partner
-            context.bot.send_voice(chat_id=partner_id, voice=file_id)
+        # Kirimkan voice note ke partner
+        context.bot.send_voice(chat_id=partner_id, voice=file_id)
+        record_session_event(user_id, partner_id, 'voice', file_id)
+        record_message_event(user_id, partner_id, 'voice', file_id,
+                             file_unique_id=voice.file_unique_id, duration=voice.duration)
             
-            # Unduh file dari Telegram
-            file = context.bot.get_file(file_id)
-            unique_timestamp = generate_unique_timestamp()
-            filename = f'voice_note_{unique_timestamp}.ogg'
-            file.download(filename)  # Simpan dengan nama file unik
-
-            # Upload file ke Firebase Storage
-            blob = bucket.blob(f'voice_notes/{filename}')
-            blob.upload_from_filename(filename)
-            
-            # Hapus file sementara setelah diupload
-            os.remove(filename)
-
-        except Exception as e:
-            logging.error(f"Failed to send voice note: {e}")
-            # Kirim pesan ke pengguna hanya jika ada masalah
-            context.bot.send_message(chat_id=user_id, text="Gagal mengirim voice note.")
+        # Arsipkan voice note ke Firebase Storage di background, sekali per file_unique_id
+        if mark_voice_archived(voice.file_unique_id):
+            submit_archive_job('storage_voice', file_id=file_id, file_unique_id=voice.file_unique_id)
     else:
         context.bot.send_message(chat_id=user_id, text="Anda belum terhubung dengan pasangan.")
 
@@ -586,49 +2456,32 @@ def handle_location(update: Update, context: CallbackContext):
     # Generate Google Maps URL
     maps_url = f"https://www.google.com/maps?q={location.latitude},{location.longitude}"
 
-    # Retrieve partner_id from Firestore
-    chat_ref = db.collection('active_chats').document(str(user_id))
-    chat = chat_ref.get()
-
-    if chat.exists:
-        partner_id = chat.to_dict().get('partner')
-        try:
-            # Send location to partner
-            context.bot.send_location(
-                chat_id=partner_id,
-                latitude=location.latitude,
-                longitude=location.longitude
-            )
+    # Retrieve partner_id from the partner cache
+    partner_id = get_partner(user_id)
 
-            # Send Google Maps URL to the user and partner
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Lokasi diterima dan dikirim ke pasangan! Latitude: {location.latitude}, Longitude: {location.longitude}\n\n[Google Maps Link]({maps_url})"
-            )
+    if partner_id is not None:
+        # Send location to partner
+        context.bot.send_location(
+            chat_id=partner_id,
+            latitude=location.latitude,
+            longitude=location.longitude
+        )
+        record_session_event(user_id, partner_id, 'location', f"{location.latitude},{location.longitude}")
 
-            # Optionally, send the Google Maps URL to the partner as well
-            context.bot.send_message(
-                chat_id=partner_id,
-                text=f"Anda telah menerima lokasi!\n\n[Google Maps Link]({maps_url})"
-            )
+        # Send Google Maps URL to the user and partner
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"Lokasi diterima dan dikirim ke pasangan! Latitude: {location.latitude}, Longitude: {location.longitude}\n\n[Google Maps Link]({maps_url})"
+        )
 
-            # Save Google Maps URL to Firestore
-            timestamp = generate_unique_timestamp()
-            message_data = {
-                'sender_id': user_id,
-                'recipient_id': partner_id,
-                'type': 'location',
-                'content': maps_url,
-                'timestamp': timestamp
-            }
-            db.collection('messages').document(timestamp).set(message_data)
-            logging.info("Location URL saved to Firestore.")
+        # Optionally, send the Google Maps URL to the partner as well
+        context.bot.send_message(
+            chat_id=partner_id,
+            text=f"Anda telah menerima lokasi!\n\n[Google Maps Link]({maps_url})"
+        )
 
-        except Exception as e:
-            logging.error(f"Failed to handle location: {e}")
-            context.bot.send_message(
-                chat_id=user_id,
-                text="Gagal memproses lokasi.")
+        # Simpan URL Google Maps ke koleksi messages lewat batch writer
+        record_message_event(user_id, partner_id, 'location', maps_url)
     else:
         context.bot.send_message(
             chat_id=user_id,
@@ -641,8 +2494,9 @@ import urllib.parse
 
 
 def get_user_info(user_id: str):
-    user_ref = db.collection('users').document(user_id)
-    user_doc = user_ref.get()
+    user_ref = get_db().collection('users').document(user_id)
+    with observe_backend('firestore', 'users.get'):
+        user_doc = user_ref.get()
 
     if user_doc.exists:
         user_data = user_doc.to_dict()
@@ -676,19 +2530,17 @@ def partner_info(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
 
     # Get the active chat for the user
-    chat_ref = db.collection('active_chats').document(str(user_id))
-    chat_doc = chat_ref.get()
+    partner_id = get_partner(user_id)
 
-    if not chat_doc.exists:
+    if partner_id is None:
         context.bot.send_message(chat_id=user_id,
                                  text="Anda tidak sedang dalam chat.")
         return
 
-    partner_id = chat_doc.to_dict().get('partner')
-
     # Retrieve partner's information
-    partner_ref = db.collection('users').document(str(partner_id))
-    partner_doc = partner_ref.get()
+    partner_ref = get_db().collection('users').document(str(partner_id))
+    with observe_backend('firestore', 'users.get'):
+        partner_doc = partner_ref.get()
 
     if not partner_doc.exists:
         context.bot.send_message(
@@ -717,6 +2569,469 @@ def partner_info(update: Update, context: CallbackContext):
 
 
 
+# Pengiriman keluar: semua pesan bot (send_message, send_photo, send_sticker,
+# send_voice, send_location, send_document, ...) melewati satu antrian.
+# Setiap chat punya antrian FIFO; grup dan channel juga punya token bucket
+# sendiri, dan semua chat berbagi token bucket global. Batas global berlaku
+# untuk seluruh bot, jadi dibagi rata antar worker. RetryAfter menjeda
+# pengiriman, NetworkError di-retry dengan backoff, dan pengguna yang
+# memblokir bot ditandai.
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))  # Batas global Telegram sekitar 30 pesan/detik
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))  # Hanya untuk grup dan channel
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', '5'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_BASE_DELAY = float(os.getenv('OUTBOX_RETRY_BASE_DELAY', '1'))
+OUTBOX_CHAT_QUEUE_LIMIT = int(os.getenv('OUTBOX_CHAT_QUEUE_LIMIT', '200'))
+OUTBOX_SHUTDOWN_TIMEOUT = float(os.getenv('OUTBOX_SHUTDOWN_TIMEOUT', '10'))
+OUTBOX_BUCKET_CACHE_SIZE = 10000
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        """Take a token if one is available; otherwise return the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (used for Telegram RetryAfter)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class OutboxDropped(Exception):
+    """Raised to callers waiting on a message the outbox gave up on; the Telegram error is the __cause__."""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+_outbox_global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE / WORKER_COUNT)
+_outbox_chat_buckets = OrderedDict()
+_outbox_chats = {}  # chat_id -> deque pengiriman (FIFO)
+_outbox_ready = []  # (waktu siap, urutan, chat_id)
+_outbox_busy = set()  # chat yang pesan terdepannya sedang dikirim
+_outbox_cond = threading.Condition()
+_outbox_seq = 0
+_outbox_workers = []
+_outbox_running = False
+_outbox_stopping = False
+_outbox_local = threading.local()
+_blocked_chats = set()
+_outbox_stats_lock = threading.Lock()  # Penghitung diubah dari beberapa thread outbox
+outbox_stats = {'sent': 0, 'retried': 0, 'rate_limited': 0, 'dropped': 0, 'blocked': 0}
+
+
+@contextmanager
+def wait_for_delivery():
+    """Make sends from this thread wait for delivery and return the Message (or raise)."""
+    previous = getattr(_outbox_local, 'wait', False)
+    _outbox_local.wait = True
+    try:
+        yield
+    finally:
+        _outbox_local.wait = previous
+
+
+def outbox_accepts():
+    # Pengiriman dari worker outbox sendiri (atau sebelum outbox berjalan) langsung dikirim
+    return _outbox_running and not getattr(_outbox_local, 'worker', False)
+
+
+def _outbox_chat_bucket(chat_id):
+    # Dipanggil dengan _outbox_cond dipegang; chat pribadi (id positif) hanya
+    # dibatasi token bucket global agar relay percakapan tidak tertahan
+    if chat_id.isdigit():
+        return None
+    bucket = _outbox_chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _outbox_chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        while len(_outbox_chat_buckets) > OUTBOX_BUCKET_CACHE_SIZE:
+            _outbox_chat_buckets.popitem(last=False)
+    else:
+        _outbox_chat_buckets.move_to_end(chat_id)
+    return bucket
+
+
+def _schedule_outbox_chat(chat_id, ready_at):
+    # Dipanggil dengan _outbox_cond dipegang
+    global _outbox_seq
+    _outbox_seq += 1
+    heapq.heappush(_outbox_ready, (ready_at, _outbox_seq, chat_id))
+    _outbox_cond.notify()
+
+
+def _drop_outbound(delivery, reason, cause=None):
+    with _outbox_stats_lock:
+        outbox_stats['dropped'] += 1
+    inc_counter('bot_outbox_dropped_total', (('reason', reason),))
+    error = OutboxDropped(f"{delivery['endpoint']} to {delivery['chat_id']} dropped: {reason}", reason)
+    error.__cause__ = cause
+    delivery['future'].set_exception(error)
+
+
+def submit_outbound(chat_id, endpoint, send):
+    """Queue send() for chat_id behind earlier messages to the same chat; returns a Future."""
+    delivery = {'chat_id': chat_id, 'endpoint': endpoint, 'send': send, 'attempt': 0,
+                'enqueued_at': time.monotonic(), 'future': Future()}
+    with _outbox_cond:
+        if chat_id in _blocked_chats:
+            _drop_outbound(delivery, 'blocked')
+            return delivery['future']
+        chat_queue = _outbox_chats.get(chat_id)
+        if chat_queue is None:
+            chat_queue = _outbox_chats[chat_id] = deque()
+        if len(chat_queue) >= OUTBOX_CHAT_QUEUE_LIMIT:
+            _drop_outbound(delivery, 'overflow')
+            return delivery['future']
+        chat_queue.append(delivery)
+        if len(chat_queue) == 1 and chat_id not in _outbox_busy:
+            _schedule_outbox_chat(chat_id, time.monotonic())
+    return delivery['future']
+
+
+def mark_chat_blocked(chat_id):
+    """Remember that the user blocked the bot; queued and later messages to them are dropped."""
+    with _outbox_cond:
+        if chat_id in _blocked_chats:
+            return
+        _blocked_chats.add(chat_id)
+        with _outbox_stats_lock:
+            outbox_stats['blocked'] += 1
+    logging.info(f'User {chat_id} blocked the bot.')
+    try:
+        with observe_backend('firestore', 'users.update'):
+            get_db().collection('users').document(str(chat_id)).update({'blocked_bot': True})
+    except Exception as e:
+        logging.warning(f'Could not mark {chat_id} as blocked: {e}')
+
+
+def unmark_chat_blocked(chat_id):
+    # Pengguna mengirim update lagi, berarti bot tidak lagi diblokir
+    if chat_id not in _blocked_chats:
+        return
+    with _outbox_cond:
+        _blocked_chats.discard(chat_id)
+    try:
+        with observe_backend('firestore', 'users.update'):
+            get_db().collection('users').document(str(chat_id)).update({'blocked_bot': False})
+    except Exception as e:
+        logging.warning(f'Could not unmark {chat_id} as blocked: {e}')
+
+
+def _next_outbox_chat():
+    # Tunggu chat yang pesan terdepannya boleh dikirim sekarang
+    with _outbox_cond:
+        while True:
+            if _outbox_stopping and not _outbox_chats:
+                return None
+            if _outbox_ready:
+                ready_at, _, chat_id = _outbox_ready[0]
+                now = time.monotonic()
+                if ready_at <= now:
+                    heapq.heappop(_outbox_ready)
+                    if chat_id in _outbox_busy or not _outbox_chats.get(chat_id):
+                        continue
+                    bucket = _outbox_chat_bucket(chat_id)
+                    wait = bucket.try_acquire() if bucket is not None else 0
+                    if wait > 0:
+                        with _outbox_stats_lock:
+                            outbox_stats['rate_limited'] += 1
+                        _schedule_outbox_chat(chat_id, now + wait)
+                        continue
+                    _outbox_busy.add(chat_id)
+                    return chat_id
+                _outbox_cond.wait(ready_at - now)
+            else:
+                _outbox_cond.wait()
+
+
+def _deliver_outbound(delivery):
+    """Send one message; returns the delay before retrying it, or None when it is finished."""
+    chat_id = delivery['chat_id']
+    try:
+        result = delivery['send']()
+    except RetryAfter as e:
+        # Batas flood Telegram: jeda chat ini dan seluruh pengiriman
+        logging.warning(f'Flood limit sending to {chat_id}, pausing {e.retry_after}s')
+        _outbox_global_bucket.pause(e.retry_after)
+        with _outbox_stats_lock:
+            outbox_stats['retried'] += 1
+        return e.retry_after
+    except Unauthorized as e:
+        mark_chat_blocked(chat_id)
+        _drop_outbound(delivery, 'blocked', e)
+        return None
+    except BadRequest as e:
+        logging.error(f"Failed to {delivery['endpoint']} to {chat_id}: {e}")
+        _drop_outbound(delivery, 'bad_request', e)
+        return None
+    except NetworkError as e:
+        delivery['attempt'] += 1
+        if delivery['attempt'] < OUTBOX_MAX_ATTEMPTS and not _outbox_stopping:
+            logging.warning(f"Network error sending to {chat_id} (attempt {delivery['attempt']}): {e}")
+            with _outbox_stats_lock:
+                outbox_stats['retried'] += 1
+            return OUTBOX_RETRY_BASE_DELAY * (2 ** (delivery['attempt'] - 1)) * random.uniform(0.8, 1.2)
+        logging.error(f"Giving up on {delivery['endpoint']} to {chat_id}: {e}")
+        _drop_outbound(delivery, 'network', e)
+        return None
+    except Exception as e:
+        logging.error(f"Failed to {delivery['endpoint']} to {chat_id}: {e}")
+        _drop_outbound(delivery, 'error', e)
+        return None
+    with _outbox_stats_lock:
+        outbox_stats['sent'] += 1
+    observe_histogram('bot_outbox_send_seconds', (('method', delivery['endpoint']),),
+                      time.monotonic() - delivery['enqueued_at'])
+    delivery['future'].set_result(result)
+    return None
+
+
+def _outbox_worker_loop():
+    _outbox_local.worker = True
+    while True:
+        chat_id = _next_outbox_chat()
+        if chat_id is None:
+            return
+        delivery = _outbox_chats[chat_id][0]
+        _outbox_global_bucket.acquire()
+        retry_in = _deliver_outbound(delivery)
+        with _outbox_cond:
+            _outbox_busy.discard(chat_id)
+            chat_queue = _outbox_chats[chat_id]
+            if retry_in is None:
+                chat_queue.popleft()
+            if chat_id in _blocked_chats:
+                while chat_queue:
+                    _drop_outbound(chat_queue.popleft(), 'blocked')
+            if chat_queue:
+                _schedule_outbox_chat(chat_id, time.monotonic() + (retry_in or 0))
+            else:
+                del _outbox_chats[chat_id]
+                _outbox_cond.notify_all()
+
+
+def start_outbox():
+    global _outbox_running, _outbox_stopping
+    _outbox_stopping = False
+    for index in range(OUTBOX_WORKERS):
+        thread = threading.Thread(target=_outbox_worker_loop, name=f'outbox-{index}', daemon=True)
+        thread.start()
+        _outbox_workers.append(thread)
+    _outbox_running = True
+
+
+def stop_outbox():
+    """Send what is still queued (up to OUTBOX_SHUTDOWN_TIMEOUT), then stop the workers."""
+    global _outbox_running, _outbox_stopping
+    _outbox_running = False
+    with _outbox_cond:
+        _outbox_stopping = True
+        _outbox_cond.notify_all()
+    deadline = time.monotonic() + OUTBOX_SHUTDOWN_TIMEOUT
+    for thread in _outbox_workers:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    with _outbox_cond:
+        # Pesan yang sedang dikirim worker dibiarkan selesai
+        for chat_id, chat_queue in list(_outbox_chats.items()):
+            keep = 1 if chat_id in _outbox_busy else 0
+            while len(chat_queue) > keep:
+                _drop_outbound(chat_queue.pop(), 'shutdown')
+            if not chat_queue:
+                del _outbox_chats[chat_id]
+        _outbox_cond.notify_all()
+    _outbox_workers.clear()
+    logging.info(f"Outbox stopped: {outbox_stats['sent']} sent, {outbox_stats['retried']} retried, "
+                 f"{outbox_stats['dropped']} dropped, {outbox_stats['blocked']} users blocked the bot")
+
+
+def get_outbox_stats():
+    with _outbox_stats_lock:
+        stats = dict(outbox_stats)
+    with _outbox_cond:
+        return dict(stats, queued=sum(len(chat_queue) for chat_queue in _outbox_chats.values()),
+                    chats=len(_outbox_chats), blocked_known=len(_blocked_chats))
+
+
+# Mesin broadcast: foto diunggah sekali lalu file_id-nya dipakai ulang,
+# pengiriman dibatasi token bucket, dan progres disimpan di Firestore
+# (koleksi broadcast_jobs) agar bisa dilanjutkan setelah restart.
+BROADCAST_PHOTO_URL = 'https://upload.wikimedia.org/wikipedia/id/6/6a/Prof_Martono_UNNES.png'  # Ganti dengan URL gambar yang sesuai
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))  # Di bawah OUTBOX_GLOBAL_RATE agar relay tetap jalan
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv('BROADCAST_CHECKPOINT_EVERY', '200'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))  # Pengiriman paralel, tetap dibatasi token bucket
+
+_broadcast_stop = threading.Event()
+_broadcast_threads = []
+
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+
+def _send_broadcast_photo(bot, recipient_id, photo_file_id, caption):
+    """Send one broadcast message; returns 'sent', 'blocked' or 'failed'."""
+    _broadcast_bucket.acquire()
+    try:
+        # Outbox sudah menangani RetryAfter dan retry NetworkError; tunggu hasil akhirnya
+        with wait_for_delivery():
+            bot.send_photo(chat_id=recipient_id, photo=photo_file_id, caption=caption)
+        return 'sent'
+    except OutboxDropped as e:
+        # Pengguna memblokir bot / akun dihapus, atau pesan gagal permanen
+        return 'blocked' if e.reason == 'blocked' else 'failed'
+
+
+def _broadcast_recipients(after_user_id):
+    # Ambil hanya ID dokumen, per halaman, terurut agar bisa dilanjutkan
+    users_ref = get_db().collection('users')
+    document_id = FieldPath.document_id()
+    while True:
+        query = users_ref.order_by(document_id).select([document_id]).limit(BROADCAST_PAGE_SIZE)
+        if after_user_id is not None:
+            query = query.start_after({document_id: after_user_id})
+        with observe_backend('firestore', 'users.stream'):
+            page = [doc.id for doc in query.stream()]
+        yield from page
+        if len(page) < BROADCAST_PAGE_SIZE:
+            return
+        after_user_id = page[-1]
+
+
+def run_broadcast_job(bot, job_id):
+    job_ref = get_db().collection('broadcast_jobs').document(job_id)
+    with observe_backend('firestore', 'broadcast_jobs.get'):
+        job = job_ref.get().to_dict()
+    counts = {key: job.get(key, 0) for key in ('sent', 'failed', 'blocked')}
+    last_user_id = job.get('last_user_id')
+    logging.info(f"Running broadcast {job_id} from {last_user_id or 'the beginning'}.")
+
+    def checkpoint(**extra):
+        with observe_backend('firestore', 'broadcast_jobs.update'):
+            job_ref.update(dict(counts, last_user_id=last_user_id, updated_at=firestore.SERVER_TIMESTAMP, **extra))
+
+    # Paling banyak BROADCAST_CONCURRENCY pengiriman berjalan; berhenti dicek
+    # sebelum setiap pengiriman dimulai, jadi semua yang sudah dimulai selesai
+    # dan checkpoint bisa maju sampai penerima terakhir yang dikirim
+    slots = threading.Semaphore(BROADCAST_CONCURRENCY)
+
+    def send(recipient_id):
+        try:
+            # Admin sudah menerima foto saat broadcast dibuat
+            if recipient_id == str(job['admin_id']):
+                return 'skipped'
+            return _send_broadcast_photo(bot, recipient_id, job['photo_file_id'], job['message'])
+        except Exception as e:
+            logging.error(f"Failed to send broadcast to {recipient_id}: {e}")
+            return 'failed'
+        finally:
+            slots.release()
+
+    recipients = _broadcast_recipients(last_user_id)
+    stopped = False
+    with ThreadPoolExecutor(BROADCAST_CONCURRENCY, thread_name_prefix=f'broadcast-{job_id}') as pool:
+        while not stopped:
+            pending = []
+            for recipient_id in itertools.islice(recipients, BROADCAST_CHECKPOINT_EVERY):
+                slots.acquire()
+                if _broadcast_stop.is_set():
+                    slots.release()
+                    stopped = True  # Belum dikirim, dilanjutkan setelah restart
+                    break
+                pending.append((recipient_id, pool.submit(send, recipient_id)))
+            if not pending and not stopped:
+                break
+            for recipient_id, future in pending:
+                outcome = future.result()
+                if outcome != 'skipped':
+                    counts[outcome] += 1
+                last_user_id = recipient_id
+            checkpoint()
+    if stopped:
+        logging.info(f"Broadcast {job_id} paused at {last_user_id}, will resume on restart.")
+        return
+
+    checkpoint(status='done')
+    try:
+        bot.send_message(
+            chat_id=job['admin_id'],
+            text=(f"Broadcast {job_id} finished.\n"
+                  f"Sent: {counts['sent']}\nFailed: {counts['failed']}\nBlocked: {counts['blocked']}"))
+    except Exception as e:
+        logging.error(f"Failed to send broadcast summary: {e}")
+
+
+def _start_broadcast_thread(bot, job_id):
+    thread = threading.Thread(target=run_broadcast_job, args=(bot, job_id), name=f'broadcast-{job_id}', daemon=True)
+    thread.start()
+    _broadcast_threads.append(thread)
+
+
+def start_broadcast_job(bot, admin_id, broadcast_message):
+    """Upload the broadcast photo once (to the admin) and start sending in the background."""
+    with wait_for_delivery():
+        preview = bot.send_photo(chat_id=admin_id, photo=BROADCAST_PHOTO_URL, caption=broadcast_message)
+    job_ref = get_db().collection('broadcast_jobs').document()
+    with observe_backend('firestore', 'broadcast_jobs.set'):
+        job_ref.set({
+            'admin_id': admin_id,
+            'message': broadcast_message,
+            'photo_file_id': preview.photo[-1].file_id,
+            'status': 'running',
+            'last_user_id': None,
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'created_at': firestore.SERVER_TIMESTAMP,
+        })
+    _start_broadcast_thread(bot, job_ref.id)
+    return job_ref.id
+
+
+def resume_broadcast_jobs(bot):
+    with observe_backend('firestore', 'broadcast_jobs.stream'):
+        jobs = list(get_db().collection('broadcast_jobs').where('status', '==', 'running').stream())
+    for job in jobs:
+        _start_broadcast_thread(bot, job.id)
+
+
+def stop_broadcast_jobs():
+    _broadcast_stop.set()
+    for thread in _broadcast_threads:
+        thread.join()
+
+
 def broadcast(update: Update, context: CallbackContext):
     # List of admin IDs
     admin_ids = [2082265412, 6069719700]
@@ -739,28 +3054,15 @@ def broadcast(update: Update, context: CallbackContext):
 
     broadcast_message = ' '.join(context.args)
 
-    # URL gambar profil bot atau gambar yang ingin dikirim
-    # Gunakan URL gambar atau ID file gambar yang diupload
-    bot_profile_photo_url = 'https://upload.wikimedia.org/wikipedia/id/6/6a/Prof_Martono_UNNES.png'  # Ganti dengan URL gambar yang sesuai
-
-    # Get all user IDs from Firestore
-    users_ref = db.collection('users')
-    users = users_ref.stream()
-
-    for user in users:
-        recipient_id = user.id
-        try:
-            # Send the photo with caption
-            context.bot.send_photo(
-                chat_id=recipient_id,
-                photo=bot_profile_photo_url,
-                caption=broadcast_message
-            )
-        except Exception as e:
-            logging.error(f"Failed to send broadcast to {recipient_id}: {e}")
+    try:
+        job_id = start_broadcast_job(context.bot, user_id, broadcast_message)
+    except Exception as e:
+        logging.error(f"Failed to start broadcast: {e}")
+        context.bot.send_message(chat_id=user_id, text="Failed to start broadcast.")
+        return
 
     context.bot.send_message(chat_id=user_id,
-                             text="Broadcast message and photo sent to all users.")
+                             text=f"Broadcast {job_id} started. You will get a summary when it finishes.")
 
 
 
@@ -768,18 +3070,13 @@ def list_banned(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
 
     # Retrieve the list of banned users
-    banned_users_ref = db.collection('banned_users')
-    banned_users_docs = banned_users_ref.stream()
+    banned_list = state_backend.list_banned()
 
-    if not banned_users_docs:
+    if not banned_list:
         context.bot.send_message(chat_id=user_id,
                                  text="No banned users found.")
         return
 
-    banned_list = []
-    for doc in banned_users_docs:
-        banned_list.append(doc.id)
-
     banned_list_text = '\n'.join(banned_list)
     context.bot.send_message(chat_id=user_id,
                              text=f"Banned Users:\n{banned_list_text}")
@@ -793,29 +3090,24 @@ def list_banned(update: Update, context: CallbackContext):
         target_id = context.args[0]
 
         # Check if the target user exists
-        target_ref = db.collection('users').document(target_id)
-        target_doc = target_ref.get()
+        target_ref = get_db().collection('users').document(target_id)
+        with observe_backend('firestore', 'users.get'):
+            target_doc = target_ref.get()
 
         if not target_doc.exists:
             context.bot.send_message(chat_id=user_id,
                                      text="The user ID does not exist.")
             return
 
-        # Move the target user to the banned_users collection
-        banned_user_ref = db.collection('banned_users').document(target_id)
-        banned_user_ref.set(target_doc.to_dict())
-
-        # Delete the target user from users collection
-        target_ref.delete()
-
-        # Remove the target user from any active chat if exists
-        db.collection('active_chats').document(target_id).delete()
+        # Move the target user to the banned list and end any active chat
+        ban_session(target_id, target_doc.to_dict())
 
         context.bot.send_message(chat_id=user_id,
                                  text=f"User {target_id} has been banned.")
     else:
         context.bot.send_message(chat_id=user_id, text="Please provide a user ID to ban.")
-        target_doc = target_ref.get()
+        with observe_backend('firestore', 'users.get'):
+            target_doc = target_ref.get()
 
         if not target_doc.exists:
             context.bot.send_message(chat_id=user_id,
@@ -850,23 +3142,21 @@ def banned_user(update: Update, context: CallbackContext):
         return
 
     # Check if the target user exists
-    target_ref = db.collection('users').document(target_id)
-    target_doc = target_ref.get()
+    target_ref = get_db().collection('users').document(target_id)
+    with observe_backend('firestore', 'users.get'):
+        target_doc = target_ref.get()
 
     if not target_doc.exists:
         context.bot.send_message(chat_id=user_id,
                                  text="The user ID does not exist.")
         return
 
-    # Move the target user to the banned_users collection
-    banned_user_ref = db.collection('banned_users').document(target_id)
-    banned_user_ref.set(target_doc.to_dict())
+    # Move the target user to the banned list and end any active chat
+    partner_id = ban_session(target_id, target_doc.to_dict())
 
-    # Delete the target user from users collection
-    target_ref.delete()
-
-    # Remove the target user from any active chat if exists
-    db.collection('active_chats').document(target_id).delete()
+    if partner_id is not None:
+        context.bot.send_message(chat_id=partner_id,
+                                 text="Pasangan Anda telah meninggalkan chat.")
 
     context.bot.send_message(chat_id=user_id,
                              text=f"User {target_id} has been banned successfully.")
@@ -894,21 +3184,16 @@ def unbanned_user(update: Update, context: CallbackContext):
 
     unbanned_user_id = context.args[0]
 
-    # Check if the user is in the banned_users collection
-    banned_user_ref = db.collection('banned_users').document(unbanned_user_id)
-    banned_user_doc = banned_user_ref.get()
+    # Check if the user is in the banned list
+    banned_user_data = state_backend.get_banned(unbanned_user_id)
 
-    if not banned_user_doc.exists:
+    if banned_user_data is None:
         context.bot.send_message(chat_id=user_id,
                                  text="User ID not found in banned list.")
         return
 
     # Move user back to users collection
-    db.collection('users').document(unbanned_user_id).set(
-        banned_user_doc.to_dict())
-
-    # Delete from banned_users collection
-    banned_user_ref.delete()
+    unban_session(unbanned_user_id, banned_user_data)
 
     context.bot.send_message(
         chat_id=user_id, text=f"User {unbanned_user_id} has been unbanned.")
@@ -917,6 +3202,7 @@ def unbanned_user(update: Update, context: CallbackContext):
 
 # List of admin IDs
 admin_ids = [2082265412, 6069719700]  # Ganti dengan ID admin yang sesuai
+REPORT_MESSAGE_LIMIT = 4000  # Batas pesan Telegram 4096 karakter
 
 def lapor_admin(update: Update, context: CallbackContext):
     # Check if the command is /lapor_admin
@@ -935,13 +3221,10 @@ def lapor_admin(update: Update, context: CallbackContext):
 
         report_text = ' '.join(args) if len(args) > 0 else "Laporan tanpa teks."
         
-        # Get the partner ID from Firestore
+        # Get the partner ID from the partner cache
         try:
-            chat_ref = db.collection('active_chats').document(str(user_id))
-            chat = chat_ref.get()
-            if chat.exists:
-                partner_id = chat.to_dict().get('partner')
-            else:
+            partner_id = get_partner(user_id)
+            if partner_id is None:
                 context.bot.send_message(chat_id=chat_id, text="Anda belum terhubung dengan pasangan.")
                 return
         except Exception as e:
@@ -949,17 +3232,31 @@ def lapor_admin(update: Update, context: CallbackContext):
             context.bot.send_message(chat_id=chat_id, text="Terjadi kesalahan saat memproses laporan.")
             return
 
+        report = (
+            f"ID Pelapor: {user_id}\n"
+            f"ID Terlapor: {partner_id}\n"
+            f"Pesan: {report_text}"
+        )
+        # Potongan percakapan diambil dari ring buffer sesi di memori
+        snippet = format_session_events(get_session_events(user_id, partner_id))
+        attach_snippet = len(report) + len(snippet) > REPORT_MESSAGE_LIMIT
+        if snippet and not attach_snippet:
+            report += f"\n\nPercakapan terakhir:\n{snippet}"
+        elif not snippet:
+            report += "\n\nPercakapan terakhir: tidak ada."
+        else:
+            report += "\n\nPercakapan terakhir: terlampir."
+
         for admin_id in admin_ids:
             try:
-                # Send text only to each admin
-                context.bot.send_message(
-                    chat_id=admin_id,
-                    text=(
-                        f"ID Pelapor: {user_id}\n"
-                        f"ID Terlapor: {partner_id}\n"
-                        f"Pesan: {report_text}"
+                context.bot.send_message(chat_id=admin_id, text=report)
+                if attach_snippet:
+                    # Terlalu panjang untuk satu pesan: kirim sebagai file
+                    context.bot.send_document(
+                        chat_id=admin_id,
+                        document=io.BytesIO(snippet.encode('utf-8')),
+                        filename=f'report_{user_id}_{partner_id}.txt'
                     )
-                )
             except Exception as e:
                 logging.error(f"Failed to send report to admin {admin_id}: {e}")
 
@@ -977,6 +3274,86 @@ def lapor_admin(update: Update, context: CallbackContext):
 
 
 
+def stats(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+
+    # Check if the user is an admin
+    if user_id not in admin_ids:
+        context.bot.send_message(
+            chat_id=user_id,
+            text="You are not authorized to use this command.")
+        return
+
+    cache_stats = get_partner_cache_stats()
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    hit_rate = (cache_stats['hits'] / lookups * 100) if lookups else 0.0
+
+    backlog = get_log_upload_backlog()
+    archive = get_archive_pipeline_stats()
+
+    stats_text = (
+        f"Partner cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+        f"({hit_rate:.1f}% hit rate), {cache_stats['size']} entries\n"
+        f"Log segments: {log_upload_stats['submitted']} sealed, "
+        f"{backlog['files']} open / {backlog['bytes']} bytes "
+        f"(oldest {backlog['oldest_age']:.0f}s)\n"
+        f"Archive: queue {archive['queue_depth']}, spooled {archive['spooled']}, "
+        f"retrying {archive['retry_pending']}, {archive['completed']} done, {archive['failed']} failed, "
+        f"latency avg {archive['latency_avg']:.1f}s / max {archive['latency_max']:.1f}s\n"
+        f"Stickers: {sticker_stats['archived']} archived, {sticker_stats['repeats']} repeats skipped\n"
+        f"Messages: {message_writer_stats['written']} written in {message_writer_stats['batches']} batches, "
+        f"{len(_message_buffer)} buffered, {message_writer_stats['failed']} failed, "
+        f"{message_writer_stats['dropped']} dropped"
+    )
+    outbox = get_outbox_stats()
+    stats_text += (
+        f"\nOutbox: {outbox['sent']} sent, {outbox['queued']} queued over {outbox['chats']} chats, "
+        f"{outbox['retried']} retried, {outbox['dropped']} dropped, {outbox['blocked']} blocked the bot"
+    )
+    updates = update_executor.get_stats()
+    stats_text += (
+        f"\nUpdates: {updates['tasks']} handled, {updates['queued']} queued over "
+        f"{updates['active_keys']} users, wait avg {updates['wait_avg'] * 1000:.0f}ms / "
+        f"max {updates['wait_max'] * 1000:.0f}ms, {updates['dropped']} dropped"
+    )
+    if WORKER_COUNT > 1:
+        stats_text += f"\nWorker: {WORKER_ID} ({WORKER_INDEX + 1} of {WORKER_COUNT})"
+    if BOT_MODE == 'webhook':
+        with _webhook_stats_lock:
+            webhook = dict(webhook_stats)
+        stats_text += (
+            f"\nWebhook: {webhook['received']} received, {webhook['rejected']} rejected, "
+            f"{webhook['dropped']} dropped, queue {get_webhook_queue_depth()}"
+        )
+    context.bot.send_message(chat_id=user_id, text=stats_text)
+
+
+
+def transcript(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+
+    if user_id not in admin_ids:
+        context.bot.send_message(
+            chat_id=user_id,
+            text="You are not authorized to use this command.")
+        return
+
+    if len(context.args) != 2:
+        context.bot.send_message(chat_id=user_id, text="Usage: /transcript <user_id> <partner_id>")
+        return
+
+    first_id, second_id = context.args
+    # Hanya blok milik pasangan ini yang dibaca dan didekompres
+    lines = read_conversation(first_id, second_id)
+    if not lines:
+        context.bot.send_message(chat_id=user_id, text=f"No conversation found between {first_id} and {second_id}.")
+        return
+
+    document = io.BytesIO(''.join(lines).encode('utf-8'))
+    context.bot.send_document(chat_id=user_id, document=document,
+                              filename=f'transcript_{first_id}_{second_id}.txt')
+
+
 def button(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
@@ -993,45 +3370,448 @@ def button(update: Update, context: CallbackContext):
 
 
 
+# Eksekusi update: update dari pengguna yang sama dijalankan berurutan,
+# sedangkan pengguna yang berbeda berjalan paralel di thread pool. Antrian
+# per pengguna dibatasi agar satu pengguna yang membanjiri bot tidak menahan
+# memori tanpa batas.
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', '50'))
+
+
+class KeyedExecutor:
+    """Run tasks with the same key one at a time in submission order; different keys run in parallel."""
+
+    def __init__(self, workers, queue_limit=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update')
+        self.queue_limit = queue_limit
+        self.pending = {}  # key -> deque of (submitted_at, fn, args)
+        self.lock = threading.Lock()
+        self.stats = {'tasks': 0, 'dropped': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+    def submit(self, key, fn, *args) -> bool:
+        """Queue fn(*args) behind earlier tasks of key; returns False if the key's queue is full."""
+        with self.lock:
+            tasks = self.pending.get(key)
+            if tasks is not None:
+                if self.queue_limit and len(tasks) >= self.queue_limit:
+                    self.stats['dropped'] += 1
+                    inc_counter('bot_update_dropped_total')
+                    return False
+                # Key ini sedang berjalan; task akan diambil setelah yang sebelumnya selesai
+                tasks.append((time.monotonic(), fn, args))
+                return True
+            self.pending[key] = deque([(time.monotonic(), fn, args)])
+        self.pool.submit(self._run_next, key)
+        return True
+
+    def _run_next(self, key):
+        with self.lock:
+            submitted_at, fn, args = self.pending[key][0]
+        wait = time.monotonic() - submitted_at
+        observe_histogram('bot_update_queue_wait_seconds', (), wait)
+        try:
+            fn(*args)
+        except Exception:
+            logging.exception(f'Error while handling update for {key}')
+        with self.lock:
+            self.stats['tasks'] += 1
+            self.stats['wait_total'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+            tasks = self.pending[key]
+            tasks.popleft()
+            if not tasks:
+                del self.pending[key]
+                return
+        # Jadwalkan ulang alih-alih loop agar key lain tetap mendapat giliran
+        self.pool.submit(self._run_next, key)
+
+    def get_stats(self):
+        with self.lock:
+            completed = self.stats['tasks']
+            return dict(self.stats,
+                        active_keys=len(self.pending),
+                        queued=sum(len(tasks) for tasks in self.pending.values()),
+                        wait_avg=(self.stats['wait_total'] / completed) if completed else 0.0)
+
+    def shutdown(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.pending:
+                    break
+            time.sleep(0.1)
+        self.pool.shutdown(wait=True)
+
+
+update_executor = KeyedExecutor(UPDATE_WORKERS, UPDATE_QUEUE_LIMIT)
+
+
+def _update_key(update: Update):
+    user = update.effective_user
+    if user is not None:
+        return user.id
+    chat = update.effective_chat
+    return chat.id if chat is not None else update.update_id
+
+
+def run_keyed(callback):
+    """Wrap a handler callback so it runs on update_executor, ordered per user."""
+    instrumented = instrument_handler(callback.__name__, callback)
+
+    @functools.wraps(callback)
+    def submit(update: Update, context: CallbackContext):
+        key = _update_key(update)
+        unmark_chat_blocked(str(key))
+        if not update_executor.submit(key, instrumented, update, context):
+            logging.warning(f'Dropped update {update.update_id} from {key}: {UPDATE_QUEUE_LIMIT} updates already queued')
+    return submit
+
+
+# Mode webhook: server HTTP bawaan menerima update dari Telegram, memvalidasi
+# secret token, lalu langsung membalas 200. Update diproses oleh worker dari
+# antrian terbatas; update pengguna yang sama selalu masuk ke worker yang
+# sama agar urutan pesan tetap terjaga.
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # 'polling', 'webhook' atau 'cluster'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # URL publik, mis. https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+_webhook_server = None
+_webhook_queues = []
+_webhook_threads = []
+_webhook_stats_lock = threading.Lock()  # Penghitung diubah dari thread server HTTP
+webhook_stats = {'received': 0, 'rejected': 0, 'dropped': 0}
+
+
+def ensure_webhook_secret():
+    """Make sure webhook and cluster mode only accept updates carrying the secret token."""
+    global WEBHOOK_SECRET
+    if WEBHOOK_SECRET:
+        return
+    if not WEBHOOK_URL:
+        # Webhook didaftarkan di luar bot, jadi secret harus diketahui dari env
+        logging.error('WEBHOOK_SECRET is required in webhook and cluster mode when WEBHOOK_URL is not set.')
+        sys.exit(1)
+    # Bot sendiri yang mendaftarkan webhook: buat secret acak untuk proses ini
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    logging.info('WEBHOOK_SECRET not set; generated a random secret token for this run.')
+
+
+def valid_webhook_secret(token: str) -> bool:
+    # Bandingkan sebagai bytes: compare_digest menolak str dengan karakter non-ASCII
+    return hmac.compare_digest(token.encode('utf-8', 'surrogateescape'), WEBHOOK_SECRET.encode('utf-8'))
+
+
+def _webhook_worker_loop(dispatcher, updates):
+    while True:
+        update = updates.get()
+        if update is None:
+            return
+        try:
+            dispatcher.process_update(update)
+        except Exception as e:
+            logging.error(f'Error processing update {update.update_id}: {e}')
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    dispatcher = None
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self._reply(404)
+            return
+        if not valid_webhook_secret(self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')):
+            with _webhook_stats_lock:
+                webhook_stats['rejected'] += 1
+            self._reply(403)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = Update.de_json(json.loads(body), self.dispatcher.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.error(f'Invalid webhook payload: {e}')
+            self._reply(400)
+            return
+
+        with _webhook_stats_lock:
+            webhook_stats['received'] += 1
+        updates = _webhook_queues[hash(_update_key(update)) % len(_webhook_queues)]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            # Telegram akan mengirim ulang update ini nanti
+            with _webhook_stats_lock:
+                webhook_stats['dropped'] += 1
+            self._reply(503)
+            return
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Webhook {self.address_string()}: {format % args}')
+
+
+def start_webhook_server(dispatcher):
+    global _webhook_server
+    queue_size = max(1, WEBHOOK_QUEUE_SIZE // WEBHOOK_WORKERS)
+    for index in range(WEBHOOK_WORKERS):
+        updates = queue.Queue(maxsize=queue_size)
+        worker = threading.Thread(target=_webhook_worker_loop, args=(dispatcher, updates),
+                                  name=f'webhook-worker-{index}', daemon=True)
+        worker.start()
+        _webhook_queues.append(updates)
+        _webhook_threads.append(worker)
+
+    WebhookRequestHandler.dispatcher = dispatcher
+    _webhook_server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookRequestHandler)
+    threading.Thread(target=_webhook_server.serve_forever, name='webhook-server', daemon=True).start()
+    logging.info(f'Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+
+    if WEBHOOK_URL:
+        api_kwargs = {'secret_token': WEBHOOK_SECRET}
+        dispatcher.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, api_kwargs=api_kwargs)
+        logging.info(f'Webhook registered at {WEBHOOK_URL}')
+
+
+def stop_webhook_server():
+    """Stop accepting updates and let the workers finish what is already queued."""
+    if _webhook_server is not None:
+        _webhook_server.shutdown()
+        _webhook_server.server_close()
+    for updates in _webhook_queues:
+        updates.put(None)
+    for worker in _webhook_threads:
+        worker.join()
+
+
+def get_webhook_queue_depth():
+    return sum(updates.qsize() for updates in _webhook_queues)
+
+
+def wait_for_stop_signal():
+    # Updater.idle() langsung memanggil os._exit jika polling tidak berjalan,
+    # jadi mode webhook menunggu sinyal sendiri agar shutdown tetap bersih.
+    stop_event = threading.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(stop_signal, lambda signum, frame: stop_event.set())
+    stop_event.wait()
+
+
+# Mode cluster: satu router menerima webhook dan meneruskan setiap update ke
+# salah satu dari WORKER_COUNT proses worker berdasarkan user id, sehingga
+# update seorang pengguna selalu diproses oleh worker yang sama.
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', '9000'))
+ROUTER_TIMEOUT = float(os.getenv('ROUTER_TIMEOUT', '10'))
+
+_router_stats_lock = threading.Lock()  # Penghitung diubah dari thread server HTTP
+router_stats = {'forwarded': 0, 'rejected': 0, 'failed': 0}
+
+
+def _payload_user_id(payload: dict):
+    # Pengirim update: message.from, callback_query.from, my_chat_member.from, ...
+    for value in payload.values():
+        if isinstance(value, dict):
+            for field in ('from', 'user', 'chat'):
+                sender = value.get(field)
+                if isinstance(sender, dict) and 'id' in sender:
+                    return int(sender['id'])
+    return int(payload.get('update_id', 0))
+
+
+def worker_for_user(user_id) -> int:
+    return int(user_id) % WORKER_COUNT
+
+
+class RouterRequestHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self._reply(404)
+            return
+        if not valid_webhook_secret(self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')):
+            with _router_stats_lock:
+                router_stats['rejected'] += 1
+            self._reply(403)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            worker_index = worker_for_user(_payload_user_id(json.loads(body)))
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.error(f'Invalid webhook payload: {e}')
+            self._reply(400)
+            return
+
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+        request = urllib.request.Request(f'http://127.0.0.1:{WORKER_BASE_PORT + worker_index}{WEBHOOK_PATH}',
+                                         data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=ROUTER_TIMEOUT) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError as e:
+            # Worker mati atau sibuk; Telegram akan mengirim ulang update ini
+            logging.error(f'Failed to forward update to worker {worker_index}: {e}')
+            status = 503
+        with _router_stats_lock:
+            router_stats['forwarded' if status == 200 else 'failed'] += 1
+        self._reply(status)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Router {self.address_string()}: {format % args}')
+
+
+def run_cluster():
+    """Run WORKER_COUNT webhook workers as child processes behind one routing webhook server."""
+    ensure_webhook_secret()
+    workers = []
+    for index in range(WORKER_COUNT):
+        env = dict(os.environ,
+                   BOT_MODE='webhook',
+                   WEBHOOK_SECRET=WEBHOOK_SECRET,
+                   WORKER_INDEX=str(index),
+                   WORKER_ID=f'{os.uname().nodename}:worker-{index}',
+                   PORT=str(WORKER_BASE_PORT + index),
+                   WEBHOOK_LISTEN='127.0.0.1',
+                   ARCHIVE_SPOOL_PATH=f'{ARCHIVE_SPOOL_PATH}.{index}',
+                   DRIVE_FILE_INDEX_PATH=f'{DRIVE_FILE_INDEX_PATH}.{index}',
+                   STICKER_INDEX_PATH=f'{STICKER_INDEX_PATH}.{index}')
+        # Hanya router yang mendaftarkan webhook dan membuka port metrik
+        env.pop('WEBHOOK_URL', None)
+        env.pop('METRICS_PORT', None)
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    logging.info(f'Started {WORKER_COUNT} workers on ports {WORKER_BASE_PORT}-{WORKER_BASE_PORT + WORKER_COUNT - 1}.')
+
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), RouterRequestHandler)
+    threading.Thread(target=server.serve_forever, name='router-server', daemon=True).start()
+    logging.info(f'Router listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+    if WEBHOOK_URL:
+        api_kwargs = {'secret_token': WEBHOOK_SECRET}
+        InstrumentedBot(TOKEN).set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, api_kwargs=api_kwargs)
+        logging.info(f'Webhook registered at {WEBHOOK_URL}')
+    report_startup('cluster')
+
+    wait_for_stop_signal()
+    server.shutdown()
+    server.server_close()
+    # SIGTERM membuat setiap worker berhenti dengan bersih (flush log, arsip, broadcast)
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.wait()
+    logging.info(f"Router stopped: {router_stats['forwarded']} forwarded, {router_stats['failed']} failed, "
+                 f"{router_stats['rejected']} rejected.")
+
+
 def main():
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
+    if BOT_MODE == 'cluster':
+        run_cluster()
+        return
+    if BOT_MODE == 'webhook':
+        ensure_webhook_secret()
 
-    # Tambahkan handler untuk perintah
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("search", search))
-    dp.add_handler(CommandHandler("stop", stop_chat))
-    dp.add_handler(CommandHandler("next", next_chat))
-    dp.add_handler(CommandHandler("userinfo", user_info))
-    dp.add_handler(CommandHandler("partnerinfo", partner_info))
-    dp.add_handler(CommandHandler("broadcast", broadcast))
-    dp.add_handler(CommandHandler("banned_user", banned_user))
-    dp.add_handler(CommandHandler("unbanned_user", unbanned_user))
-    dp.add_handler(CommandHandler("list_banned", list_banned))
+    # Bot dengan metrik per metode Bot API; pool koneksi cukup untuk semua
+    # thread yang memanggil Telegram (update, arsip, broadcast)
+    request = Request(con_pool_size=UPDATE_WORKERS + ARCHIVE_WORKERS + 4)
+    updater = Updater(bot=InstrumentedBot(TOKEN, request=request), use_context=True)
+    dp = updater.dispatcher
+    check_drive_credentials()
+    start_metrics_server()
+
+    # Muat antrian pencarian sekali saat startup
+    state_backend.start()
+    load_waiting_queue()
+    start_session_watch()
+    load_banned_users()
+    load_log_segments()
+    load_sticker_index()
+    start_archive_pipeline(updater.bot)
+    start_log_uploader()
+    start_message_writer()
+    start_outbox()
+    # Broadcast tertunda dilanjutkan di background agar tidak menunda polling;
+    # dengan beberapa worker hanya worker pertama yang melanjutkannya
+    if WORKER_INDEX == 0:
+        threading.Thread(target=resume_broadcast_jobs, args=(updater.bot,), name='broadcast-resume',
+                         daemon=True).start()
+
+    # Tolak pengguna ter-banned sebelum handler lain dijalankan
+    dp.add_handler(TypeHandler(Update, reject_banned_user), group=-1)
+
+    # Tambahkan handler untuk perintah (dijalankan lewat update_executor:
+    # berurutan per pengguna, paralel antar pengguna)
+    dp.add_handler(CommandHandler("start", run_keyed(start)))
+    dp.add_handler(CommandHandler("search", run_keyed(search)))
+    dp.add_handler(CommandHandler("stop", run_keyed(stop_chat)))
+    dp.add_handler(CommandHandler("next", run_keyed(next_chat)))
+    dp.add_handler(CommandHandler("userinfo", run_keyed(user_info)))
+    dp.add_handler(CommandHandler("partnerinfo", run_keyed(partner_info)))
+    dp.add_handler(CommandHandler("broadcast", run_keyed(broadcast)))
+    dp.add_handler(CommandHandler("banned_user", run_keyed(banned_user)))
+    dp.add_handler(CommandHandler("unbanned_user", run_keyed(unbanned_user)))
+    dp.add_handler(CommandHandler("list_banned", run_keyed(list_banned)))
+    dp.add_handler(CommandHandler("stats", run_keyed(stats)))
+    dp.add_handler(CommandHandler("transcript", run_keyed(transcript)))
 
 
    
     # Add handler for text messages that are not commands
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command & ~Filters.regex('^/lapor_admin'), handle_message))
-    dp.add_handler(CommandHandler("lapor_admin", lapor_admin))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command & ~Filters.regex('^/lapor_admin'), run_keyed(handle_message)))
+    dp.add_handler(CommandHandler("lapor_admin", run_keyed(lapor_admin)))
 
   
 
     # dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
-    dp.add_handler(MessageHandler(Filters.sticker, handle_message))
-    dp.add_handler(MessageHandler(Filters.photo, handle_photo))
-    dp.add_handler(MessageHandler(Filters.voice, handle_voice_note))
-    dp.add_handler(MessageHandler(Filters.location, handle_location))
+    dp.add_handler(MessageHandler(Filters.sticker, run_keyed(handle_message)))
+    dp.add_handler(MessageHandler(Filters.photo, run_keyed(handle_photo)))
+    dp.add_handler(MessageHandler(Filters.voice, run_keyed(handle_voice_note)))
+    dp.add_handler(MessageHandler(Filters.location, run_keyed(handle_location)))
 
 
 
     # Tambahkan handler untuk tombol inline
-    dp.add_handler(CallbackQueryHandler(button))
+    dp.add_handler(CallbackQueryHandler(run_keyed(button)))
+
+    if BOT_MODE == 'webhook':
+        start_webhook_server(dp)
+        report_startup('webhook')
+        wait_for_stop_signal()
+        stop_webhook_server()
+    else:
+        updater.start_polling()
+        report_startup('polling')
+        updater.idle()
 
-    updater.start_polling()
-    updater.idle()
+    # Selesaikan update yang sedang berjalan, simpan progres broadcast dan
+    # unggah semua log sebelum proses berhenti
+    update_executor.shutdown()
+    stop_broadcast_jobs()
+    stop_outbox()
+    stop_banned_listener()
+    stop_session_watch()
+    state_backend.close()
+    stop_log_uploader()
+    stop_message_writer()
+    stop_archive_pipeline()
 
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['migrate-history']:
+        migrate_user_history()
+    else:
+        main()
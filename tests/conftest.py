@@ -0,0 +1,29 @@
+"""Fixtures that load main.py against the in-memory fakes of benchmark.py."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def bot_module(tmp_path_factory):
+    # Tanpa latensi buatan: tes memeriksa perilaku, bukan throughput
+    benchmark.LATENCY.clear()
+    return benchmark.load_bot_module(str(tmp_path_factory.mktemp('bot')))
+
+
+@pytest.fixture
+def main(bot_module):
+    """main.py with a fresh fake database and the memory state backend."""
+    benchmark.reset_state(bot_module)
+    bot_module.state_backend = bot_module.create_state_backend('memory')
+    return bot_module
+
+
+@pytest.fixture
+def bot():
+    return benchmark.FakeBot()
@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+def test_claim_pairs_with_the_oldest_waiting_user(main):
+    main.enqueue_waiting('1')
+    main.enqueue_waiting('2')
+
+    assert main.claim_waiting_partner('3') == '1'
+    assert main.get_partner('3') == '1'
+    assert main.get_partner('1') == '3'
+    assert main.is_waiting('2')
+
+
+def test_symmetric_claim_does_not_requeue_the_new_partner(main):
+    # A mengambil B sementara B mengambil A; klaim B harus kalah tanpa
+    # mengembalikan A (yang sudah dipasangkan) ke antrian
+    main.enqueue_waiting('A')
+    main.enqueue_waiting('B')
+    claim_pair = main.state_backend.claim_pair
+    barrier = threading.Barrier(2)
+
+    def delayed_claim_pair(user_id, partner_id, owner=None):
+        barrier.wait(timeout=5)
+        if user_id == 'B':
+            time.sleep(0.05)
+        return claim_pair(user_id, partner_id, owner)
+
+    main.state_backend.claim_pair = delayed_claim_pair
+    results = {}
+    threads = [threading.Thread(target=lambda key=key: results.update({key: main.claim_waiting_partner(key)}))
+               for key in ('A', 'B')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert results == {'A': 'B', 'B': None}
+    assert main.get_partner('A') == 'B'
+    assert main.get_partner('B') == 'A'
+    assert not main.is_waiting('A')
+    assert not main.is_waiting('B')
+    assert main.state_backend.load_waiting() == []
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+from telegram.error import Unauthorized
+
+
+class FakeRequest:
+    """Bot API transport that answers every send with a minimal Message."""
+
+    def __init__(self):
+        self.calls = []
+
+    def post(self, url, data, timeout=None):
+        self.calls.append((url.rsplit('/', 1)[-1], data))
+        return {'message_id': len(self.calls), 'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': 'private'}, 'text': data.get('text')}
+
+
+@pytest.fixture
+def outbox(main, monkeypatch):
+    monkeypatch.setattr(main, '_outbox_global_bucket', main.TokenBucket(1000))
+    monkeypatch.setattr(main, 'OUTBOX_CHAT_RATE', 20)
+    monkeypatch.setattr(main, 'OUTBOX_CHAT_BURST', 1)
+    monkeypatch.setattr(main, 'OUTBOX_RETRY_BASE_DELAY', 0.01)
+    main._outbox_chat_buckets.clear()
+    main._blocked_chats.clear()
+    main.start_outbox()
+    yield main
+    main.stop_outbox()
+
+
+def _send_many(main, chat_id, count):
+    started = time.monotonic()
+    futures = [main.submit_outbound(chat_id, 'sendMessage', lambda index=index: index) for index in range(count)]
+    results = [future.result(timeout=5) for future in futures]
+    return results, time.monotonic() - started
+
+
+def test_messages_to_one_chat_are_sent_in_order(outbox):
+    results, _ = _send_many(outbox, '42', 20)
+    assert results == list(range(20))
+
+
+def test_private_chats_are_not_limited_per_chat(outbox):
+    _, elapsed = _send_many(outbox, '42', 10)
+    assert elapsed < 0.2
+
+
+def test_groups_are_limited_per_chat(outbox):
+    # 20/detik dengan burst 1: 10 pesan butuh paling sedikit 9 / 20 detik
+    _, elapsed = _send_many(outbox, '-100', 10)
+    assert elapsed >= 0.4
+
+
+def test_final_failures_are_reported_as_outbox_dropped(outbox):
+    def blocked():
+        raise Unauthorized('Forbidden: bot was blocked by the user')
+
+    future = outbox.submit_outbound('7', 'sendMessage', blocked)
+    error = future.exception(timeout=5)
+    assert isinstance(error, outbox.OutboxDropped)
+    assert error.reason == 'blocked'
+    assert isinstance(error.__cause__, Unauthorized)
+
+    later = outbox.submit_outbound('7', 'sendMessage', lambda: 'never sent')
+    assert later.exception(timeout=5).reason == 'blocked'
+
+
+def test_instrumented_bot_sends_through_the_outbox(outbox):
+    request = FakeRequest()
+    bot = outbox.InstrumentedBot('123:abc', request=request)
+
+    assert bot.send_message(chat_id=5, text='queued') is None
+    with outbox.wait_for_delivery():
+        message = bot.send_message(chat_id=5, text='waited')
+
+    assert message.text == 'waited'
+    assert [data['text'] for _, data in request.calls] == ['queued', 'waited']
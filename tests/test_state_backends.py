@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture(params=['firestore', 'memory', 'file'])
+def backend(request, main, tmp_path, monkeypatch):
+    if request.param == 'file':
+        monkeypatch.setattr(main, 'STATE_FILE_PATH', str(tmp_path / 'state.json'))
+    state_backend = main.create_state_backend(request.param)
+    state_backend.start()
+    yield state_backend
+    state_backend.close()
+
+
+def test_only_one_concurrent_claim_of_a_waiting_user_wins(backend):
+    backend.add_waiting('900')
+    barrier = threading.Barrier(8)
+    results = []
+
+    def claim(user_id):
+        barrier.wait(timeout=5)
+        results.append((user_id, backend.claim_pair(user_id, '900')))
+
+    threads = [threading.Thread(target=claim, args=(str(100 + index),)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    winners = [user_id for user_id, claimed in results if claimed]
+    assert len(winners) == 1
+    assert str(backend.get_partner('900')) == winners[0]  # firestore menyimpan id partner sebagai int
+    assert str(backend.get_partner(winners[0])) == '900'
+    assert backend.load_waiting() == []
+
+
+def test_unpair_clears_both_sides(backend):
+    backend.add_waiting('902')
+    assert backend.claim_pair('901', '902')
+    backend.unpair('901', '902')
+    assert backend.get_partner('901') is None
+    assert backend.get_partner('902') is None
+
+
+def test_ban_and_unban_are_kept_in_firestore(backend, main):
+    main.get_db().collection('users').document('910').set({'username': 'u'})
+    backend.add_waiting('911')
+    backend.claim_pair('910', '911')
+    changes = []
+    unsubscribe = backend.watch_banned(lambda added, removed: changes.append((added, removed)))
+
+    backend.ban('910', {'username': 'u'}, partner_id='911')
+    assert backend.get_banned('910') == {'username': 'u'}
+    assert backend.list_banned() == ['910']
+    assert main._db.data['banned_users']['910'] == {'username': 'u'}
+    assert '910' not in main._db.data['users']
+    assert backend.get_partner('910') is None
+    assert backend.get_partner('911') is None
+
+    backend.unban('910', {'username': 'u'})
+    assert backend.get_banned('910') is None
+    assert main._db.data['users']['910'] == {'username': 'u'}
+    assert (['910'], []) in changes and ([], ['910']) in changes
+    unsubscribe()
+
+
+def test_memory_snapshot_keeps_sessions_but_not_bans(main, tmp_path):
+    snapshot_path = str(tmp_path / 'snapshot.json')
+    state_backend = main.MemoryStateBackend(snapshot_path)
+    state_backend.add_waiting('900')
+    state_backend.add_waiting('902')
+    state_backend.claim_pair('901', '902')
+    state_backend.close()
+
+    restored = main.MemoryStateBackend(snapshot_path)
+    assert restored.load_waiting() == ['900']
+    assert restored.get_partner('901') == '902'
+    assert not hasattr(restored, '_banned')
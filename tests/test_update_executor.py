@@ -0,0 +1,42 @@
+import threading
+import time
+
+
+def test_tasks_of_one_key_run_in_submission_order(main):
+    executor = main.KeyedExecutor(4)
+    order = []
+
+    for index in range(20):
+        # Task awal lebih lambat: tanpa urutan per key, task berikutnya akan menyalip
+        executor.submit('user', lambda index=index: (time.sleep(0.002 * (20 - index)), order.append(index)))
+    executor.shutdown(timeout=5)
+
+    assert order == list(range(20))
+
+
+def test_different_keys_run_in_parallel(main):
+    executor = main.KeyedExecutor(2)
+    barrier = threading.Barrier(2)
+    passed = []
+
+    for key in ('a', 'b'):
+        executor.submit(key, lambda: passed.append(barrier.wait(timeout=2)))
+    executor.shutdown(timeout=5)
+
+    assert len(passed) == 2
+
+
+def test_queue_limit_drops_updates_of_a_flooding_key(main):
+    executor = main.KeyedExecutor(2, queue_limit=3)
+    release = threading.Event()
+    handled = []
+
+    accepted = [executor.submit('flood', lambda index=index: (release.wait(2), handled.append(index)))
+                for index in range(5)]
+    assert executor.submit('other', handled.append, 'other')
+    release.set()
+    executor.shutdown(timeout=5)
+
+    assert accepted == [True, True, True, False, False]
+    assert sorted(handled, key=str) == [0, 1, 2, 'other']
+    assert executor.get_stats()['dropped'] == 2
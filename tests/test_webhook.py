@@ -0,0 +1,53 @@
+import http.client
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def webhook(main, bot, monkeypatch):
+    monkeypatch.setattr(main, 'WEBHOOK_SECRET', 'secret')
+    monkeypatch.setattr(main, 'WEBHOOK_URL', None)
+    monkeypatch.setattr(main, 'WEBHOOK_LISTEN', '127.0.0.1')
+    monkeypatch.setattr(main, 'WEBHOOK_PORT', 0)
+    monkeypatch.setattr(main, '_webhook_queues', [])
+    monkeypatch.setattr(main, '_webhook_threads', [])
+    processed = []
+    done = threading.Event()
+
+    def process_update(update):
+        processed.append(update.update_id)
+        done.set()
+
+    main.start_webhook_server(SimpleNamespace(bot=bot, process_update=process_update))
+    yield main._webhook_server.server_address[1], processed, done
+    main.stop_webhook_server()
+
+
+def _post(port, token, payload):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    headers = {'Content-Type': 'application/json'}
+    if token is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = token
+    connection.request('POST', '/telegram', body=json.dumps(payload).encode(), headers=headers)
+    return connection.getresponse().status
+
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'},
+                                      'from': {'id': 5, 'is_bot': False, 'first_name': 'a'}, 'text': 'hi'}}
+
+
+@pytest.mark.parametrize('token', [None, 'wrong', 'sécret'.encode().decode('latin-1')])
+def test_updates_without_the_secret_are_rejected(webhook, token):
+    port, processed, _ = webhook
+    assert _post(port, token, UPDATE) == 403
+    assert processed == []
+
+
+def test_updates_with_the_secret_are_processed(webhook):
+    port, processed, done = webhook
+    assert _post(port, 'secret', UPDATE) == 200
+    assert done.wait(5)
+    assert processed == [1]